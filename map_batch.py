@@ -0,0 +1,152 @@
+from map_rewrite import Map
+import map_output
+import map_cache
+import numpy as np
+import concurrent.futures
+import multiprocessing
+import argparse
+import os
+
+
+# The steps from the README, each one is a method of Map and its arguments
+pipeline = (
+    ('generate_landmass', {}),
+    ('remove_lone_tiles', {'threshold': 1}),
+    ('centre_landmass', {}),
+    ('generate_heatmap', {}),
+    ('soften_heatmap', {}),
+    ('generate_terrain', {}),
+    ('outline_landmass', {}),
+)
+
+
+def generate(height, width, seed, steps=pipeline, image=None, pixel_size=1,
+             cache=None, progress=None, rng='legacy', order='tiles'):
+    """ Generates a map and returns its grids as arrays, along with an encoded
+        image of the map if an image format is given. Steps found in the cache
+        are not run again, and progress is passed on to Map.run_step """
+
+    if image is None:
+        output = map_output.Output()
+    else:
+        output = map_output.Image(height, width, pixel_size)
+
+    map = Map(height, width, seed, output, max_states=1, rng=rng,
+              order=order)
+    if cache is not None:
+        map_cache.generate(map, steps, cache, progress)
+    else:
+        for step in steps:
+            if isinstance(step, str):
+                step = (step, {})
+            name, kwargs = step
+            map.run_step(name, kwargs, progress)
+
+    result = {'seed': seed}
+    if hasattr(map, 'landmass'):
+        result['landmass'] = map.landmass.values
+    if hasattr(map, 'heatmap'):
+        result['heatmap'] = map.heatmap.values
+        result['resolution'] = map.resolution
+    if hasattr(map, 'terrain'):
+        result['elevation'] = map.elevation.values
+        result['terrain'] = map.terrain.values
+    if image is not None:
+        result['image'] = output.encode(map, image)
+    return result
+
+
+def generate_job(job):
+    return generate(*job)
+
+
+def generate_many(height, width, seeds, steps=pipeline, workers=None,
+                  image=None, pixel_size=1, cache=None, threads=False,
+                  rng='legacy', order='tiles'):
+    """ Generates a map for each seed, spread across a pool of processes, and
+        yields the results in the order of the seeds. Every map draws from a
+        generator of its own, so each map is identical to one generated on its
+        own. Processes only share the entries of a cache saved to disk.
+
+        With threads, the maps are generated on a pool of threads in this
+        process instead and share the cache in memory. With order='rounds'
+        every step runs on whole arrays and releases the GIL for much of its
+        work, so threads overlap, but tile by tile the collapsing steps hold
+        the GIL and threads overlap far less than processes do """
+
+    jobs = [(height, width, seed, steps, image, pixel_size, cache, None, rng,
+             order) for seed in seeds]
+    if workers == 1:
+        yield from map(generate_job, jobs)
+        return
+
+    if threads:
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            yield from executor.map(generate_job, jobs)
+        return
+
+    with multiprocessing.Pool(workers) as pool:
+        yield from pool.imap(generate_job, jobs, chunksize=1)
+
+
+def save(result, directory, image=None):
+    """ Saves a result as an image, or as a file of arrays, named after its
+        seed """
+
+    seed = result['seed']
+    if image is not None:
+        path = os.path.join(directory, f'{seed}.{image}')
+        with open(path, 'wb') as file:
+            file.write(result['image'])
+    else:
+        path = os.path.join(directory, f'{seed}.npz')
+        arrays = {k: v for k, v in result.items() if isinstance(v, np.ndarray)}
+        np.savez_compressed(path, **arrays)
+    return path
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Generates maps for many seeds across processes')
+    parser.add_argument('height', type=int)
+    parser.add_argument('width', type=int)
+    parser.add_argument('seeds', type=int, nargs='*',
+                        help='seeds to generate, defaults to --count seeds '
+                             'counting up from --start')
+    parser.add_argument('--start', type=int, default=0)
+    parser.add_argument('--count', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of processes, defaults to the CPU count')
+    parser.add_argument('--threads', action='store_true',
+                        help='generate on threads instead of processes')
+    parser.add_argument('--rng', choices=('legacy', 'streams'),
+                        default='legacy',
+                        help='how random numbers are drawn, streams give '
+                             'different maps')
+    parser.add_argument('--order', choices=Map.orders, default='tiles',
+                        help='how the landmass and heatmap collapse, rounds '
+                             'release the GIL but give different maps')
+    parser.add_argument('--image', choices=('png', 'ppm'), default=None,
+                        help='save images instead of arrays')
+    parser.add_argument('--pixel-size', type=int, default=1)
+    parser.add_argument('--out', default='.')
+    parser.add_argument('--cache', default=None,
+                        help='a directory to cache the state after each step')
+    args = parser.parse_args(args)
+
+    seeds = args.seeds or range(args.start, args.start + args.count)
+    os.makedirs(args.out, exist_ok=True)
+    cache = None
+    if args.cache is not None:
+        cache = map_cache.Cache(directory=args.cache)
+    results = generate_many(args.height, args.width, seeds,
+                            workers=args.workers, image=args.image,
+                            pixel_size=args.pixel_size, cache=cache,
+                            threads=args.threads, rng=args.rng,
+                            order=args.order)
+    for result in results:
+        print(save(result, args.out, args.image))
+
+
+if __name__ == '__main__':
+    main()
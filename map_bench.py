@@ -0,0 +1,195 @@
+from map_rewrite import Map
+import map_output
+import map_batch
+import numpy as np
+import subprocess
+import tracemalloc
+import argparse
+import platform
+import statistics
+import json
+import time
+import sys
+import os
+
+
+# The modules a worker process starts by importing
+imports = ('map_rewrite', 'map_batch', 'map_service')
+
+# Run in a new interpreter to time an import, printing the time it took and
+# whether pygame was loaded along the way
+import_script = '''
+import time, sys
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start, 'pygame' in sys.modules)
+'''
+
+
+def run(size, seed, memory=False, rng='legacy', order='tiles'):
+    """ Runs every step on a square map with a null output, returning the
+        wall time of each step and, if asked for, its peak memory. Memory is
+        measured with tracemalloc, which slows everything down, so times and
+        memory should come from separate runs """
+
+    map = Map(size, size, seed, map_output.Output(), rng=rng, order=order)
+    results = dict()
+    for name, kwargs in map_batch.pipeline:
+        if memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        getattr(map, name)(**kwargs)
+        elapsed = time.perf_counter() - start
+        result = {'time': elapsed}
+        if memory:
+            result['peak'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        results[name] = result
+    return results
+
+
+def import_time(module, repeats=5):
+    """ Returns the median time to import a module in a new interpreter,
+        as a worker process would on starting, and whether pygame was
+        imported with it """
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+    times = list()
+    for _ in range(repeats):
+        output = subprocess.run(
+            [sys.executable, '-c', import_script.format(module=module)],
+            cwd=directory, capture_output=True, text=True,
+            check=True).stdout.split()
+        times.append(float(output[0]))
+    return {'time': statistics.median(times), 'pygame': output[1] == 'True'}
+
+
+def fit(sizes, times):
+    """ Returns the exponent k which best fits time = c * tiles^k """
+
+    tiles = [size*size for size in sizes]
+    if len(tiles) < 2:
+        return None
+    k, _ = np.polyfit(np.log(tiles), np.log(times), 1)
+    return round(float(k), 3)
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(sizes, seeds, memory=True, rng='legacy', order='tiles'):
+    """ Benchmarks every step at every size, taking the median time over the
+        seeds and the largest peak memory, with maps of the given random
+        number generator and order """
+
+    report = {
+        'commit': commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'sizes': list(sizes),
+        'seeds': list(seeds),
+        'rng': rng,
+        'order': order,
+        'steps': {name: {'sizes': dict()} for name, _ in map_batch.pipeline},
+        'imports': {module: import_time(module) for module in imports},
+    }
+    for size in sizes:
+        runs = [run(size, seed, rng=rng, order=order) for seed in seeds]
+        if memory:
+            peaks = [run(size, seed, True, rng, order) for seed in seeds]
+        for name, _ in map_batch.pipeline:
+            result = {'time': statistics.median(r[name]['time'] for r in runs)}
+            if memory:
+                result['peak'] = max(r[name]['peak'] for r in peaks)
+            report['steps'][name]['sizes'][str(size)] = result
+
+    for name, step in report['steps'].items():
+        times = [step['sizes'][str(size)]['time'] for size in sizes]
+        step['exponent'] = fit(sizes, times)
+    return report
+
+
+def describe(report, previous=None, threshold=1.2):
+    """ Returns a table of the report, compared with a previous report if one
+        is given. Steps which take longer than the threshold times their
+        previous time are marked as regressions """
+
+    lines = [f"{'step':<20}{'size':>7}{'time (s)':>12}{'peak (MiB)':>12}"
+             f"{'vs prev':>10}"]
+    for name, step in report['steps'].items():
+        for size, result in step['sizes'].items():
+            peak = result.get('peak')
+            peak = f'{peak / 2**20:.1f}' if peak is not None else '-'
+            change = ''
+            try:
+                before = previous['steps'][name]['sizes'][size]['time']
+            except (TypeError, KeyError):
+                before = None
+            if before:
+                ratio = result['time'] / before
+                change = f'{ratio:.2f}x'
+                if ratio > threshold:
+                    change += ' !'
+            lines.append(f"{name:<20}{size:>7}{result['time']:>12.4f}"
+                         f"{peak:>12}{change:>10}")
+        if step['exponent'] is not None:
+            fitted = f"n^{step['exponent']}"
+            lines.append(f"{name:<20}{'fit':>7}{fitted:>12}")
+
+    lines.append('')
+    lines.append(f"{'import':<20}{'time (s)':>19}{'pygame':>12}"
+                 f"{'vs prev':>10}")
+    for module, result in report.get('imports', {}).items():
+        change = ''
+        try:
+            before = previous['imports'][module]['time']
+        except (TypeError, KeyError):
+            before = None
+        if before:
+            ratio = result['time'] / before
+            change = f'{ratio:.2f}x'
+            if ratio > threshold:
+                change += ' !'
+        pygame = 'yes' if result['pygame'] else 'no'
+        lines.append(f"{module:<20}{result['time']:>19.4f}{pygame:>12}"
+                     f"{change:>10}")
+    return '\n'.join(lines)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks each step of map generation across sizes')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[64, 128, 256])
+    parser.add_argument('--seeds', type=int, nargs='+', default=[1, 2, 3])
+    parser.add_argument('--rng', choices=('legacy', 'streams'),
+                        default='legacy')
+    parser.add_argument('--order', choices=Map.orders, default='tiles',
+                        help='how the landmass and heatmap collapse')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip measuring peak memory')
+    parser.add_argument('--out', help='save the report as JSON')
+    parser.add_argument('--compare', help='a previous JSON report')
+    parser.add_argument('--threshold', type=float, default=1.2)
+    args = parser.parse_args(args)
+
+    report = benchmark(args.sizes, args.seeds, not args.no_memory, args.rng,
+                       args.order)
+    previous = None
+    if args.compare:
+        with open(args.compare) as file:
+            previous = json.load(file)
+    print(describe(report, previous, args.threshold))
+    if args.out:
+        with open(args.out, 'w') as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
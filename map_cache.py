@@ -0,0 +1,242 @@
+from map_rewrite import Grid, History, Map
+import numpy as np
+import collections
+import itertools
+import hashlib
+import inspect
+import threading
+import json
+import os
+
+
+def describe_steps(steps):
+    """ Returns each step as its name and every argument it is called with,
+        including the defaults, so that equal calls are described equally """
+
+    described = list()
+    for step in steps:
+        if isinstance(step, str):
+            step = (step, {})
+        name, kwargs = step
+        method = inspect.unwrap(getattr(Map, name))
+        arguments = inspect.signature(method).bind(None, **kwargs)
+        arguments.apply_defaults()
+        arguments = dict(arguments.arguments)
+        del arguments['self']
+        described.append((name, arguments))
+    return described
+
+
+def key(map, steps):
+    """ Returns the key of the state of a new map after the given steps. Only
+        what changes the result is part of the key """
+
+    description = {
+        'seed': map.seed,
+        'height': map.height,
+        'width': map.width,
+        'layers': Map.layers,
+        'climates': Map.climates,
+        'rng': map.rng.name,
+        'order': map.order,
+        'steps': describe_steps(steps),
+    }
+    data = json.dumps(description, sort_keys=True).encode()
+    return hashlib.sha256(data).hexdigest()
+
+
+class Entry:
+
+    def __init__(self, state, seed, next_seed, random_state):
+        """ The state of a map after a step, with the seed the step saved its
+            state with, the seed drawn for the next step and the state of the
+            map's random number generator, which steps that do not seed it
+            carry on from """
+
+        self.state = state
+        self.seed = seed
+        self.next_seed = next_seed
+        self.random_state = random_state
+
+    @staticmethod
+    def take(map):
+        """ Returns an entry for the state the map has just saved """
+
+        # The latest state of the history is a copy which is never changed
+        state = map.states.latest
+        return Entry(state, map.states.seeds[-1], map.seed,
+                     map.rng.getstate())
+
+    def restore(self, map):
+        """ Sets the map to the state, as if it had just been saved """
+
+        for name in History.attributes:
+            if name not in self.state:
+                if hasattr(map, name):
+                    delattr(map, name)
+                continue
+            value = self.state[name]
+            if isinstance(value, np.ndarray):
+                width, height = value.shape
+                value = Grid(height, width, value.copy())
+            setattr(map, name, value)
+
+        map.seed = self.seed
+        map.states.append(map)
+        map.seed = self.next_seed
+        map.rng.setstate(self.random_state)
+
+    def arrays(self):
+        """ Returns the entry as arrays, to be saved to disk """
+
+        arrays = {
+            'seeds': np.array([self.seed, self.next_seed], dtype=np.uint64),
+        }
+        if self.random_state is not None:
+            version, internal, gauss = self.random_state
+            arrays['random'] = np.array(internal, dtype=np.uint32)
+            arrays['random_version'] = np.array(version)
+            arrays['random_gauss'] = np.array(np.nan if gauss is None
+                                              else gauss)
+        for name, value in self.state.items():
+            arrays[name] = np.asarray(value)
+        return arrays
+
+    @staticmethod
+    def from_arrays(arrays):
+        state = dict()
+        for name in History.attributes:
+            if name in arrays:
+                value = arrays[name]
+                if value.ndim == 0:
+                    value = value.item()
+                elif value.ndim == 1:
+                    value = tuple(value.tolist())
+                state[name] = value
+        seed, next_seed = (int(seed) for seed in arrays['seeds'])
+        random_state = None
+        if 'random' in arrays:
+            gauss = float(arrays['random_gauss'])
+            random_state = (int(arrays['random_version']),
+                            tuple(int(n) for n in arrays['random']),
+                            None if np.isnan(gauss) else gauss)
+        return Entry(state, seed, next_seed, random_state)
+
+
+class Cache:
+
+    def __init__(self, size=64, directory=None):
+        """ Stores the states of maps after each step by the key of the steps
+            taken. Up to size entries are kept in memory, the least recently
+            used are forgotten first. If a directory is given every entry is
+            also saved there, and entries missing from memory are looked for
+            there. A cache can be shared by maps on different threads """
+
+        self.size = size
+        self.directory = directory
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def __getstate__(self):
+        """ Caches sent to other processes leave their lock and the entries in
+            memory behind, only the entries saved to disk are shared """
+
+        return {'size': self.size, 'directory': self.directory}
+
+    def __setstate__(self, state):
+        self.__init__(state['size'], state['directory'])
+
+    def path(self, key):
+        return os.path.join(self.directory, f'{key}.npz')
+
+    def __contains__(self, key):
+        if key in self.entries:
+            return True
+        return self.directory is not None and os.path.exists(self.path(key))
+
+    def get(self, key):
+        """ Returns the entry with the given key, or None """
+
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        if self.directory is None:
+            return None
+        try:
+            with np.load(self.path(key)) as arrays:
+                entry = Entry.from_arrays(arrays)
+        except FileNotFoundError:
+            return None
+        self.remember(key, entry)
+        return entry
+
+    def put(self, key, entry):
+        self.remember(key, entry)
+        if self.directory is not None:
+            # Written to a temporary file first so a half written entry is
+            # never read
+            path = self.path(key)
+            temporary = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(temporary, 'wb') as file:
+                np.savez_compressed(file, **entry.arrays())
+            os.replace(temporary, path)
+
+    def remember(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def generate(map, steps, cache, progress=None):
+    """ Runs the steps on a new map, starting from the state after the last
+        step found in the cache. Steps which save a state store it in the
+        cache, steps which only draw, such as outlining, are always run.
+        Progress is passed on to Map.run_step """
+
+    if len(map.states) or hasattr(map, 'landmass'):
+        raise Exception('Map has already been generated')
+
+    steps = [(step, {}) if isinstance(step, str) else step for step in steps]
+    keys = [key(map, steps[:i+1]) for i in range(len(steps))]
+
+    start = 0
+    for i in reversed(range(len(steps))):
+        entry = cache.get(keys[i])
+        if entry is not None:
+            entry.restore(map)
+            render(map)
+            start = i + 1
+            break
+
+    for (name, kwargs), step_key in zip(steps[start:], keys[start:]):
+        latest = map.states.latest
+        map.run_step(name, kwargs, progress)
+        if map.states.latest is not latest:
+            cache.put(step_key, Entry.take(map))
+    return map
+
+
+def render(map):
+    """ Draws a restored map to its output """
+
+    if hasattr(map, 'landmass'):
+        map.output.map_relief(map.landmass)
+    if hasattr(map, 'heatmap'):
+        heatmap = map.heatmap
+        tiles = [heatmap[x][y] for x, y in itertools.product(
+            range(heatmap.width), range(heatmap.height))]
+        map.output.overlay_temperatures(tiles, map.landmass, map.resolution)
+    if hasattr(map, 'terrain'):
+        for event in map.iter_features(0, 0, map.width, map.height):
+            map.output.tiles_relief(event.tiles)
+    map.output.flush()
@@ -0,0 +1,153 @@
+from map_rewrite import Grid, Map
+import map_kernels
+import map_random
+import numpy as np
+import hashlib
+import random
+import os
+
+
+def derive_seed(seed, *key):
+    """ Returns a 32 bit seed for part of a world from the world's seed """
+
+    data = repr((seed,) + key).encode()
+    return int.from_bytes(hashlib.blake2b(data, digest_size=4).digest(), 'big')
+
+
+class World:
+
+    def __init__(self, seed=None, chunk_size=256, directory=None, land=0.5,
+                 control=10000, rng='legacy', order='tiles'):
+        """ A landmass of any size made of square chunks which are generated
+            when they are first asked for, and stored in the directory if one
+            is given.
+
+            The tiles around the border of a chunk come from the edges and
+            corners it shares with its neighbours, each generated with a seed
+            derived from its position, so a chunk never needs its neighbours
+            to be generated and chunks match up in whatever order they are
+            generated in. The random number generator is 'legacy' or
+            'streams', see map_random, and the order is 'tiles' or 'rounds',
+            see Map """
+
+        # The number of tiles either side of a chunk's border which are shared
+        # with its neighbour, enough to cover every layer of adjacent tiles
+        self.band = Map.layers
+        if chunk_size <= 2*self.band:
+            raise Exception(f'Chunks must be larger than {2*self.band} tiles')
+
+        if seed is None:
+            seed = random.randint(0, 2**32-1)
+        self.seed = seed
+        self.chunk_size = chunk_size
+        self.land = land
+        self.control = control
+        self.rng = map_random.make(rng)
+        if order not in Map.orders:
+            raise Exception(f'Unknown order {order!r}')
+        self.order = order
+
+        self.directory = directory
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def collapse(self, grid, rng):
+        """ Collapses every tile of the grid which has not been collapsed,
+            drawing from the given stream """
+
+        collapsed = grid.values != -1
+        grid.flags = map_kernels.adjacent_to(collapsed)
+        tiles = np.flatnonzero(~collapsed).tolist()
+        rng.shuffle(tiles)
+        tiles = grid.schedule(tiles)
+        Map.collapse_land(grid, tiles, self.control, rng,
+                          self.order == 'rounds')
+
+    def corner(self, i, j):
+        """ Returns the square of tiles around the point where the corners of
+            four chunks meet, the chunk (i, j) being to its bottom right """
+
+        size = 2*self.band
+        grid = Grid(size, size)
+        key = ('corner', i, j)
+        rng = self.rng.stream(derive_seed(self.seed, *key), *key)
+        value = Map.land if rng.random() < self.land else Map.water
+        grid.collapse(self.band, self.band, value)
+        self.collapse(grid, rng)
+        return grid.values
+
+    def edge(self, i, j, vertical):
+        """ Returns the strip of tiles along the left or top border of the
+            chunk (i, j), including the corners at either end """
+
+        size = 2*self.band
+        length = self.chunk_size + size
+        if vertical:
+            grid = Grid(length, size)
+            grid.values[:, :size] = self.corner(i, j)
+            grid.values[:, -size:] = self.corner(i, j+1)
+        else:
+            grid = Grid(size, length)
+            grid.values[:size, :] = self.corner(i, j)
+            grid.values[-size:, :] = self.corner(i+1, j)
+        key = ('edge', i, j, vertical)
+        rng = self.rng.stream(derive_seed(self.seed, *key), *key)
+        self.collapse(grid, rng)
+        return grid.values
+
+    def path(self, i, j):
+        return os.path.join(self.directory, f'{i}_{j}.npy')
+
+    def chunk(self, i, j):
+        """ Returns the landmass of the chunk (i, j), indexed by x then y """
+
+        if self.directory is not None and os.path.exists(self.path(i, j)):
+            return np.load(self.path(i, j))
+
+        size = 2*self.band
+        length = self.chunk_size + size
+        grid = Grid(length, length)
+        grid.values[:size, :] = self.edge(i, j, True)
+        grid.values[-size:, :] = self.edge(i+1, j, True)
+        grid.values[:, :size] = self.edge(i, j, False)
+        grid.values[:, -size:] = self.edge(i, j+1, False)
+        key = ('chunk', i, j)
+        rng = self.rng.stream(derive_seed(self.seed, *key), *key)
+        self.collapse(grid, rng)
+
+        band = self.band
+        values = grid.values[band:-band, band:-band].copy()
+        if self.directory is not None:
+            np.save(self.path(i, j), values)
+        return values
+
+    def region(self, x1, y1, x2, y2):
+        """ Returns the landmass between the given world positions, only the
+            chunks which overlap the region are generated """
+
+        size = self.chunk_size
+        values = np.empty((x2 - x1, y2 - y1), dtype=np.int8)
+        for i in range(x1 // size, (x2 - 1) // size + 1):
+            for j in range(y1 // size, (y2 - 1) // size + 1):
+                chunk = self.chunk(i, j)
+                cx1 = max(x1, i*size)
+                cy1 = max(y1, j*size)
+                cx2 = min(x2, (i+1)*size)
+                cy2 = min(y2, (j+1)*size)
+                values[cx1-x1:cx2-x1, cy1-y1:cy2-y1] = \
+                    chunk[cx1-i*size:cx2-i*size, cy1-j*size:cy2-j*size]
+        return values
+
+    def map(self, x1, y1, x2, y2, output=None):
+        """ Returns a map of the region with its landmass generated, so the
+            other steps can be run on it """
+
+        values = self.region(x1, y1, x2, y2)
+        width, height = values.shape
+        seed = derive_seed(self.seed, 'map', x1, y1, x2, y2)
+        map = Map(height, width, seed, output, rng=self.rng.copy(),
+                  order=self.order)
+        map.landmass = Grid(height, width, values)
+        map.output.map_relief(map.landmass)
+        map.save_state()
+        return map
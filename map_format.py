@@ -0,0 +1,98 @@
+from map_rewrite import Grid, Map
+import numpy as np
+import struct
+
+
+# A map file starts with a header followed by the values of the landmass and
+# heatmap, each stored as one byte per tile indexed by x then y
+magic = b'MAPG'
+version = 1
+header = struct.Struct('<4sHHIIQIIII')
+header_size = 64
+
+has_landmass = 1
+has_heatmap = 2
+
+
+class Header:
+
+    def __init__(self, width, height, seed, resolution=0, step=0,
+                 heat_width=0, heat_height=0, flags=0):
+        """ Describes the contents of a map file """
+
+        self.width = width
+        self.height = height
+        self.seed = seed
+        self.resolution = resolution
+        self.step = step
+        self.heat_width = heat_width
+        self.heat_height = heat_height
+        self.flags = flags
+
+    def pack(self):
+        data = header.pack(magic, version, self.flags, self.width,
+                           self.height, self.seed, self.resolution, self.step,
+                           self.heat_width, self.heat_height)
+        return data.ljust(header_size, b'\0')
+
+    @staticmethod
+    def unpack(data):
+        fields = header.unpack(data[:header.size])
+        if fields[0] != magic:
+            raise Exception('Not a map file')
+        if fields[1] != version:
+            raise Exception(f'Unsupported map file version {fields[1]}')
+        (_, _, flags, width, height, seed,
+         resolution, step, heat_width, heat_height) = fields
+        return Header(width, height, seed, resolution, step, heat_width,
+                      heat_height, flags)
+
+
+def read_header(path):
+    """ Returns the header of a map file """
+
+    with open(path, 'rb') as file:
+        return Header.unpack(file.read(header_size))
+
+
+def save(map, path):
+    """ Saves the map's dimensions, seed and grids to a file """
+
+    info = Header(map.width, map.height, map.seed, step=len(map.states))
+    planes = list()
+    if hasattr(map, 'landmass'):
+        info.flags |= has_landmass
+        planes.append(map.landmass.values)
+    if hasattr(map, 'heatmap'):
+        info.flags |= has_heatmap
+        info.resolution = map.resolution
+        info.heat_width = map.heatmap.width
+        info.heat_height = map.heatmap.height
+        planes.append(map.heatmap.values)
+
+    with open(path, 'wb') as file:
+        file.write(info.pack())
+        for values in planes:
+            np.ascontiguousarray(values, dtype=np.int8).tofile(file)
+
+
+def load(path, output=None, mode='c'):
+    """ Loads a map from a file. The grids are memory mapped so only the parts
+        of the file which are used are read, by default changes to the grids
+        are kept in memory and not written back to the file """
+
+    info = read_header(path)
+    map = Map(info.height, info.width, info.seed, output)
+
+    offset = header_size
+    if info.flags & has_landmass:
+        shape = (info.width, info.height)
+        values = np.memmap(path, np.int8, mode, offset, shape)
+        map.landmass = Grid(info.height, info.width, values)
+        offset += info.width*info.height
+    if info.flags & has_heatmap:
+        shape = (info.heat_width, info.heat_height)
+        values = np.memmap(path, np.int8, mode, offset, shape)
+        map.heatmap = Grid(info.heat_height, info.heat_width, values)
+        map.resolution = info.resolution
+    return map
@@ -0,0 +1,303 @@
+import numpy as np
+
+
+# Offsets of the adjacent tiles visited before and after a tile when the grid
+# is walked column by column
+before = ((-1, -1), (-1, 0), (-1, 1), (0, -1))
+after = ((0, 1), (1, -1), (1, 0), (1, 1))
+
+# The value given to positions outside of the grid, it never matches a tile
+outside = -128
+
+
+def shift(padded, dx, dy, shape):
+    """ Returns the values of the tiles at the given offset from each tile,
+        from an array padded by one tile on every side """
+
+    width, height = shape
+    return padded[1+dx:1+dx+width, 1+dy:1+dy+height]
+
+
+def count_matching(values, neighbours, offsets):
+    """ Counts the adjacent tiles at the given offsets with the same value as
+        each tile """
+
+    padded = np.pad(neighbours, 1, constant_values=outside)
+    count = np.zeros(values.shape, dtype=np.int8)
+    for dx, dy in offsets:
+        count += shift(padded, dx, dy, values.shape) == values
+    return count
+
+
+def remove_lone_tiles(values, threshold, land, water, sequential=True):
+    """ Swaps land and water tiles with no more than threshold adjacent tiles
+        of the same value.
+
+        When sequential, the result is identical to visiting the tiles column
+        by column and swapping them in place, so a tile sees the new values of
+        the tiles visited before it. The update is repeated until it no longer
+        changes, as each repeat settles at least one more tile along every
+        chain of dependent tiles """
+
+    swappable = (values == land) | (values == water)
+    swapped = np.where(values == land, water, land).astype(values.dtype)
+    count_after = count_matching(values, values, after)
+
+    new_values = values
+    while True:
+        count = count_after + count_matching(values, new_values, before)
+        lone = swappable & (count <= threshold)
+        result = np.where(lone, swapped, values)
+        if not sequential or np.array_equal(result, new_values):
+            return result
+        new_values = result
+
+
+def centre_landmass(values, land, water):
+    """ Returns the land shifted so that its bounds, which always include the
+        centre of the grid, are in the centre of the grid. Every other tile
+        becomes water """
+
+    width, height = values.shape
+    is_land = values == land
+    xs, ys = np.nonzero(is_land)
+
+    x1 = min(width // 2, xs.min(initial=width))
+    y1 = min(height // 2, ys.min(initial=height))
+    x2 = max(width // 2, xs.max(initial=-1))
+    y2 = max(height // 2, ys.max(initial=-1))
+
+    dx = (width - (x2 - x1)) // 2 - x1
+    dy = (height - (y2 - y1)) // 2 - y1
+
+    # The shifted bounds always fit in the grid so nothing is wrapped around
+    shifted = np.roll(is_land, (dx, dy), axis=(0, 1))
+    return np.where(shifted, land, water).astype(values.dtype)
+
+
+def outline_landmass(values, land, water):
+    """ Returns a mask of the water tiles directly next to land """
+
+    padded = np.pad(values, 1, constant_values=outside)
+    coast = np.zeros(values.shape, dtype=bool)
+    for dx, dy in ((0, -1), (1, 0), (0, 1), (-1, 0)):
+        coast |= shift(padded, dx, dy, values.shape) == land
+    return coast & (values == water)
+
+
+def adjacent_to(mask):
+    """ Returns a mask of the tiles with an adjacent tile in the given mask """
+
+    padded = np.pad(mask, 1, constant_values=False)
+    adjacent = np.zeros(mask.shape, dtype=bool)
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            if dx or dy:
+                adjacent |= shift(padded, dx, dy, mask.shape)
+    return adjacent
+
+
+def distance_to(mask):
+    """ Returns the number of steps, not counting diagonal steps, from each
+        tile to the nearest tile in the mask. This is the same as a breadth
+        first search from every tile in the mask at once, but is done as a
+        sweep each way along each axis, each over the whole grid at once """
+
+    width, height = mask.shape
+    distance = np.where(mask, 0, width + height).astype(np.int32)
+    for axis, size in ((1, height), (0, width)):
+        steps = np.arange(size, dtype=np.int32)
+        steps = steps[None, :] if axis else steps[:, None]
+        # The nearest tile before each tile is the one with the lowest
+        # distance less its position, and after it plus its position
+        forward = np.minimum.accumulate(distance - steps, axis=axis) + steps
+        backward = np.flip(np.minimum.accumulate(
+            np.flip(distance + steps, axis), axis=axis), axis) - steps
+        distance = np.minimum(forward, backward)
+    return distance
+
+
+def value_noise(lattice, scale, shape):
+    """ Returns smooth noise of the given shape, interpolated between values
+        on a lattice with the given spacing """
+
+    def axis(size):
+        position = np.arange(size) / scale
+        index = position.astype(np.intp)
+        fraction = position - index
+        return index, fraction*fraction*(3 - 2*fraction)
+
+    xi, xf = axis(shape[0])
+    yi, yf = axis(shape[1])
+    xi, xf = xi[:, None], xf[:, None]
+    yi, yf = yi[None, :], yf[None, :]
+
+    top = lattice[xi, yi]*(1 - yf) + lattice[xi, yi+1]*yf
+    bottom = lattice[xi+1, yi]*(1 - yf) + lattice[xi+1, yi+1]*yf
+    return top*(1 - xf) + bottom*xf
+
+
+def summed_area(mask):
+    """ Returns the summed area table of a mask, with a row and column of
+        zeros before it, so the sum of any box is found from four corners """
+
+    width, height = mask.shape
+    table = np.zeros((width + 1, height + 1), dtype=np.int32)
+    np.cumsum(mask, axis=0, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+    return table
+
+
+def box_sums(table, xs, ys, radius):
+    """ Returns the sum of the square of tiles within the radius of each
+        position, clipped to the bounds of the grid """
+
+    width, height = table.shape[0] - 1, table.shape[1] - 1
+    x1 = np.clip(xs - radius, 0, width)
+    x2 = np.clip(xs + radius + 1, 0, width)
+    y1 = np.clip(ys - radius, 0, height)
+    y2 = np.clip(ys + radius + 1, 0, height)
+    return table[x2, y2] - table[x1, y2] - table[x2, y1] + table[x1, y1]
+
+
+def ring_sums(table, xs, ys, weights):
+    """ Returns the number of tiles in each layer around each position, not
+        counting the tile itself, weighted by the weight of the layer """
+
+    total = 0
+    inner = box_sums(table, xs, ys, 0)
+    for layer, weight in enumerate(weights, 1):
+        box = box_sums(table, xs, ys, layer)
+        total = total + weight*(box - inner)
+        inner = box
+    return total
+
+
+def window_offsets(radius, height):
+    """ Returns the offsets of the tiles within the radius of a tile, in a
+        square, as indices into a flattened grid of the given height, along
+        with the layer each of them is in """
+
+    offsets = list()
+    layers = list()
+    for dx in range(-radius, radius+1):
+        for dy in range(-radius, radius+1):
+            if dx or dy:
+                offsets.append(dx*height + dy)
+                layers.append(max(abs(dx), abs(dy)))
+    return np.array(offsets), np.array(layers)
+
+
+def collapse_land(values, pending, generator, control, weights, total, land,
+                  water):
+    """ Collapses the pending tiles to land or water a round at a time,
+        changing the values in place and yielding the positions collapsed in
+        each round. Every tile is given a random priority, and each round the
+        pending tiles beside a collapsed tile which come first of those
+        within as many layers as are counted are collapsed at once. No two
+        tiles of a round count each other, so each is drawn from exactly the
+        tiles it would see if the tiles were collapsed one at a time, as
+        Map.pick_land draws them.
+
+        Only the tiles ready to collapse are looked at each round, so a round
+        takes time in proportion to the length of the coast rather than the
+        area of the grid. The grids are padded by the radius counted, so the
+        tiles around a tile are found by adding offsets to its index """
+
+    radius = len(weights)
+    width, height = values.shape
+    padded_height = height + 2*radius
+    inside = (slice(radius, radius+width), slice(radius, radius+height))
+
+    # Tiles of the padding are neither land nor water, never pending and
+    # never come first
+    padded = np.full((width + 2*radius, padded_height), -2, dtype=values.dtype)
+    padded[inside] = values
+    padded = padded.ravel()
+    left = np.zeros((width + 2*radius, padded_height), dtype=bool)
+    left[inside] = pending
+    priority = np.full(left.shape, np.inf)
+    priority[inside] = generator.random(values.shape)
+    ready = np.zeros(left.shape, dtype=bool)
+    ready[inside] = pending & adjacent_to(values != -1)
+    remaining = int(pending.sum())
+    left, priority, ready = left.ravel(), priority.ravel(), ready.ravel()
+
+    offsets, layers = window_offsets(radius, padded_height)
+    scale = np.array(weights)[layers - 1]
+    inner = layers == 1
+    adjacent = offsets[inner]
+    frontier = np.flatnonzero(ready)
+
+    while remaining:
+        if len(frontier):
+            window = frontier[:, None] + offsets
+            earlier = priority[window] < priority[frontier][:, None]
+            first = ~(ready[window] & earlier).any(axis=1)
+            chosen = np.sort(frontier[first])
+            frontier = frontier[~first]
+        else:
+            # Nothing to grow from, so one tile is picked to start from
+            indices = np.flatnonzero(left)
+            chosen = indices[[generator.integers(len(indices))]]
+        xs, ys = np.divmod(chosen, padded_height)
+        xs -= radius
+        ys -= radius
+
+        around = padded[chosen[:, None] + offsets]
+        is_water = around == water
+        is_land = around == land
+        weighted_water = (is_water * scale).sum(axis=1)
+        weighted_land = (is_land * scale).sum(axis=1)
+        inner_water = is_water[:, inner].sum(axis=1)
+        inner_land = is_land[:, inner].sum(axis=1)
+        weighted = weighted_water + weighted_land
+
+        draws = generator.random((4, len(xs)))
+        chance = (draws[0]*control).astype(np.int64) + 1
+        weighted_chance = (draws[1]*total).astype(np.int64) + 1
+        inner_chance = (draws[2]*8).astype(np.int64) + 1
+        last_chance = (draws[3]*weighted).astype(np.int64) + 1
+        picked = np.select(
+            [chance == 1, chance == 2,
+             weighted_chance <= weighted_water,
+             weighted_chance <= weighted,
+             inner_chance <= inner_water,
+             inner_chance <= inner_water + inner_land,
+             weighted == 0,
+             last_chance <= weighted_water],
+            [water, land, water, land, water, land,
+             np.where(draws[3] < 0.5, water, land), water],
+            land)
+
+        padded[chosen] = picked
+        values[xs, ys] = picked
+        left[chosen] = False
+        ready[chosen] = False
+        remaining -= len(chosen)
+
+        # The pending tiles beside those collapsed join the frontier
+        beside = np.unique((chosen[:, None] + adjacent).ravel())
+        beside = beside[left[beside] & ~ready[beside]]
+        ready[beside] = True
+        frontier = np.concatenate((frontier, beside))
+        yield xs, ys
+
+
+def soften(values, generator, weights, count, batches=64):
+    """ Softens the values in place, yielding the positions softened in each
+        batch. The tiles are split into random batches, and every tile of a
+        batch is drawn at once as Map.pick_climate draws a tile, from the
+        weighted counts of each value around it as it was before the batch """
+
+    height = values.shape[1]
+    order = generator.permutation(values.size)
+    for batch in np.array_split(order, batches):
+        xs, ys = np.divmod(batch, height)
+        counts = np.stack([
+            ring_sums(summed_area(values == value), xs, ys, weights)
+            for value in range(count)])
+        cumulative = np.cumsum(counts, axis=0)
+        chance = generator.random(len(batch))*cumulative[-1]
+        values[xs, ys] = (chance >= cumulative[:-1]).sum(axis=0)
+        yield xs, ys
@@ -1,10 +1,14 @@
 import os
 os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide"
 
-import pygame
-
+import numpy as np
 import threading
-import queue
+import struct
+import zlib
+
+# Imported by the first PyGame output, so that maps can be generated without
+# pygame installed or paying for it to load
+pygame = None
 
 
 def midcolor(color1, color2):
@@ -83,24 +87,81 @@ class Output:
     def tile_relief(self, tile):
         pass
 
+    def tiles_relief(self, tiles):
+        """ Outputs the relief of many tiles at once """
+
+        for tile in tiles:
+            self.tile_relief(tile)
+
     def map_relief(self, grid):
         pass
 
     def overlay_temperature(self, tile, landmass, resolution=1):
         pass
 
+    def overlay_temperatures(self, tiles, landmass, resolution=1):
+        """ Outputs the temperature of many tiles at once """
+
+        for tile in tiles:
+            self.overlay_temperature(tile, landmass, resolution)
+
+    def plot(self, pos, color):
+        pass
+
+    def plot_tiles(self, positions, color):
+        """ Plots many tiles in the same color at once """
+
+        for pos in positions:
+            self.plot(pos, color)
+
+    def region_update(self, x, y, colors):
+        """ Outputs an array of colors, indexed by x then y, with its top left
+            corner at the given position """
+
+        pass
+
+    def flush(self):
+        """ Called once the output of a step has been given """
+
+        pass
+
 
 class PyGame(Output):
 
-    def __init__(self, height, width, pixel_size=2):
+    # The number of tiles along each side of the blocks the window is redrawn
+    # in, only blocks which have been drawn to since the last frame are copied
+    block = 16
+
+    def __init__(self, height, width, pixel_size=2, fps=60):
+        """ Displays the map as it generates. Tiles are drawn straight into a
+            frame of one pixel per tile, and fps times a second the blocks of
+            the frame drawn to since the last frame are copied to the window
+            and updated on the display together. The map never waits for the
+            window, and the memory used does not grow however fast it
+            generates """
+
+        global pygame
+        import pygame
 
         self.height = height
         self.width = width
         self.pixel_size = pixel_size
+        self.fps = fps
 
         self.dimensions = (width*pixel_size, height*pixel_size)
 
-        self.queue = queue.Queue()
+        self.reliefs = np.array(Colors.reliefs, dtype=np.uint8)
+        self.temperatures = np.array(Colors.temperatures, dtype=np.uint8)
+        self.colors = np.array(Colors.colors, dtype=np.uint8)
+
+        # The frame is indexed by x then y, as the window's pixels are
+        self.frame = np.zeros((width, height, 3), dtype=np.uint8)
+        size = PyGame.block
+        self.dirty = np.zeros((-(-width // size), -(-height // size)),
+                              dtype=bool)
+        # Held while the map draws into the frame and while a frame is copied
+        # to the window
+        self.lock = threading.Lock()
 
     def run(self, main_loop):
 
@@ -122,58 +183,238 @@ class PyGame(Output):
     def event_loop(self):
         clock = pygame.time.Clock()
         while True:
-            clock.tick(60)
+            clock.tick(self.fps)
             self.event_check()
-            items = 0
-            while not self.queue.empty():
-                self.event_check()
-                code, data = self.queue.get()
-                if code == 'pixel':
-                    pos, color = data
-                    self.window.set_at(pos, color)
-                elif code == 'clear':
-                    self.window.fill((0, 0, 0))
-                if items % 200 == 0:
-                    pygame.display.update()
-                items += 1
-            pygame.display.update()
+            self.draw_frame()
+
+    def dirty_rects(self, dirty):
+        """ Returns the runs of dirty blocks along each row of blocks, as the
+            positions of the tiles at their corners """
+
+        size = PyGame.block
+        rects = list()
+        padded = np.pad(dirty, ((1, 1), (0, 0)))
+        changes = np.diff(padded.astype(np.int8), axis=0)
+        for j in range(dirty.shape[1]):
+            starts = np.flatnonzero(changes[:, j] == 1)
+            ends = np.flatnonzero(changes[:, j] == -1)
+            y1, y2 = j*size, min((j+1)*size, self.height)
+            for i1, i2 in zip(starts.tolist(), ends.tolist()):
+                rects.append((i1*size, y1, min(i2*size, self.width), y2))
+        return rects
+
+    def draw_frame(self):
+        """ Copies the blocks of the frame drawn to since the last frame to
+            the window, then updates those parts of the display """
+
+        size = self.pixel_size
+        with self.lock:
+            if not self.dirty.any():
+                return
+            rects = self.dirty_rects(self.dirty)
+            self.dirty[:] = False
+
+            pixels = pygame.surfarray.pixels3d(self.window)
+            for x1, y1, x2, y2 in rects:
+                colors = self.frame[x1:x2, y1:y2]
+                colors = colors.repeat(size, axis=0).repeat(size, axis=1)
+                pixels[x1*size:x2*size, y1*size:y2*size] = colors
+            del pixels
+
+        pygame.display.update([
+            pygame.Rect(x1*size, y1*size, (x2 - x1)*size, (y2 - y1)*size)
+            for x1, y1, x2, y2 in rects])
+
+    def draw_tiles(self, xs, ys, colors):
+        """ Draws tiles scattered across the map into the frame """
+
+        size = PyGame.block
+        with self.lock:
+            self.frame[xs, ys] = colors
+            self.dirty[xs // size, ys // size] = True
+
+    def draw_region(self, x, y, colors):
+        """ Draws a block of tiles into the frame, cut off by the edges of the
+            map """
+
+        colors = colors[:self.width - x, :self.height - y]
+        width, height = colors.shape[:2]
+        size = PyGame.block
+        with self.lock:
+            self.frame[x:x+width, y:y+height] = colors
+            self.dirty[x // size:-(-(x + width) // size),
+                       y // size:-(-(y + height) // size)] = True
 
     def clear(self):
-        self.queue.put(('clear', None))
+        with self.lock:
+            self.frame[:] = 0
+            self.dirty[:] = True
 
     def plot(self, pos, color):
-        for x_off in range(self.pixel_size):
-            for y_off in range(0, self.pixel_size):
-                x = pos[0]*self.pixel_size + x_off
-                y = pos[1]*self.pixel_size + y_off
-                self.queue.put(('pixel', ((x, y), color)))
+        self.plot_tiles([pos], color)
+
+    def plot_tiles(self, positions, color):
+        if not positions:
+            return
+        xs, ys = np.array(positions, dtype=np.intp).T
+        self.draw_tiles(xs, ys, np.array(color, dtype=np.uint8))
+
+    def region_update(self, x, y, colors):
+        self.draw_region(x, y, np.asarray(colors, dtype=np.uint8))
 
     def tile_relief(self, tile):
-        color = Colors.reliefs[tile.value]
-        self.plot((tile.x, tile.y), color)
+        self.tiles_relief([tile])
+
+    def tiles_relief(self, tiles):
+        if not tiles:
+            return
+        xs = np.array([tile.x for tile in tiles], dtype=np.intp)
+        ys = np.array([tile.y for tile in tiles], dtype=np.intp)
+        values = np.array([tile.value for tile in tiles], dtype=np.intp)
+        self.draw_tiles(xs, ys, self.reliefs[values])
 
     def tile_temperature(self, tile, resolution=1):
-        color = Colors.temperatures[tile.value]
-        for x_off in range(resolution):
-            for y_off in range(resolution):
-                x = tile.x*resolution + x_off
-                y = tile.y*resolution + y_off
-                self.plot((x, y), color)
+        color = self.temperatures[tile.value]
+        colors = np.broadcast_to(color, (resolution, resolution, 3))
+        self.region_update(tile.x*resolution, tile.y*resolution, colors)
 
     def map_relief(self, grid):
-        for col in grid:
-            for tile in col:
-                self.tile_relief(tile)
+        self.region_update(0, 0, self.reliefs[grid.values])
 
     def overlay_temperature(self, tile, landmass, resolution=1):
-        x_off = tile.x*resolution
-        y_off = tile.y*resolution
-        for x in range(resolution):
-            if x+x_off >= self.width:
-                break
-            for y in range(resolution):
-                if y+y_off >= self.height:
-                    break
-                under_tile = landmass[x+x_off][y+y_off]
-                color = Colors.colors[under_tile.value][tile.value]
-                self.plot((x+x_off, y+y_off), color)
+        self.overlay_temperatures([tile], landmass, resolution)
+
+    def overlay_temperatures(self, tiles, landmass, resolution=1):
+        if not tiles:
+            return
+        xs = np.array([tile.x for tile in tiles], dtype=np.intp)
+        ys = np.array([tile.y for tile in tiles], dtype=np.intp)
+        values = np.array([tile.value for tile in tiles], dtype=np.intp)
+
+        # Each tile covers a square of tiles the size of the resolution, which
+        # is cut off by the edges of the map
+        offs = np.arange(resolution)
+        xs = (xs[:, None, None]*resolution + offs[None, :, None])
+        ys = (ys[:, None, None]*resolution + offs[None, None, :])
+        xs, ys = np.broadcast_arrays(xs, ys)
+        values = np.broadcast_to(values[:, None, None], xs.shape)
+        inside = (xs < self.width) & (ys < self.height)
+        xs, ys, values = xs[inside], ys[inside], values[inside]
+
+        under = landmass.values[xs, ys]
+        self.draw_tiles(xs, ys, self.colors[under, values])
+
+
+class Image(Output):
+
+    def __init__(self, height, width, pixel_size=1):
+        """ Builds images of maps without a display. Nothing is drawn while
+            the map generates, the image is built from the map's grids once it
+            is saved """
+
+        self.height = height
+        self.width = width
+        self.pixel_size = pixel_size
+
+        self.reliefs = np.array(Colors.reliefs, dtype=np.uint8)
+        self.colors = np.array(Colors.colors, dtype=np.uint8)
+
+        # Each row of the buffer starts with a byte for the PNG filter type,
+        # which is always 0 so the rows can be compressed as they are
+        rows = height*pixel_size
+        cols = width*pixel_size
+        self.buffer = np.zeros((rows, 1 + cols*3), dtype=np.uint8)
+        self.pixels = self.buffer[:, 1:].reshape(rows, cols, 3)
+
+        # The color plotted on each tile, until the tile is drawn over
+        self.outlines = dict()
+
+    def clear(self):
+        self.outlines = dict()
+
+    def tiles_relief(self, tiles):
+        if self.outlines:
+            for tile in tiles:
+                self.outlines.pop(tile.pos, None)
+
+    def map_relief(self, grid):
+        self.outlines = dict()
+
+    def overlay_temperatures(self, tiles, landmass, resolution=1):
+        if self.outlines:
+            offs = range(resolution)
+            for tile in tiles:
+                x = tile.x*resolution
+                y = tile.y*resolution
+                for x_off in offs:
+                    for y_off in offs:
+                        self.outlines.pop((x + x_off, y + y_off), None)
+
+    def plot_tiles(self, positions, color):
+        for pos in positions:
+            self.outlines[tuple(pos)] = color
+
+    def render(self, map):
+        """ Draws the map into the image buffer """
+
+        landmass = map.landmass.values
+        if hasattr(map, 'heatmap'):
+            res = map.resolution
+            heatmap = map.heatmap.values.repeat(res, axis=0).repeat(res, axis=1)
+            heatmap = heatmap[:self.width, :self.height]
+            colors = self.colors[landmass, heatmap]
+        else:
+            colors = self.reliefs[landmass]
+        colors = colors.copy()
+        if hasattr(map, 'terrain'):
+            # Lakes and mountains are drawn over the landmass, as
+            # Map.iter_features draws them
+            terrain = map.terrain.values
+            features = terrain >= map.lake
+            colors[features] = self.reliefs[terrain[features]]
+        if self.outlines:
+            xs, ys = np.array(list(self.outlines), dtype=np.intp).T
+            colors[xs, ys] = list(self.outlines.values())
+
+        # The grids are indexed by x then y but the image by row, so y then x
+        size = self.pixel_size
+        pixels = self.pixels.reshape(self.height, size, self.width, size, 3)
+        pixels[:] = colors.transpose(1, 0, 2)[:, None, :, None]
+
+    def encode(self, map, format='png'):
+        """ Returns an image of the map as a PNG or PPM file """
+
+        self.render(map)
+        if format == 'png':
+            return self.png()
+        elif format == 'ppm':
+            return self.ppm()
+        raise Exception(f'Unknown image format {format!r}')
+
+    def save(self, map, path):
+        """ Saves an image of the map as a PNG or PPM file """
+
+        data = self.encode(map, path.rsplit('.', 1)[-1].lower())
+        with open(path, 'wb') as file:
+            file.write(data)
+
+    def ppm(self):
+        rows, cols = self.pixels.shape[:2]
+        header = f'P6\n{cols} {rows}\n255\n'.encode()
+        return header + self.pixels.tobytes()
+
+    def png(self):
+
+        def chunk(kind, data):
+            length = struct.pack('>I', len(data))
+            crc = struct.pack('>I', zlib.crc32(kind + data))
+            return length + kind + data + crc
+
+        rows, cols = self.pixels.shape[:2]
+        header = struct.pack('>IIBBBBB', cols, rows, 8, 2, 0, 0, 0)
+        return b''.join((
+            b'\x89PNG\r\n\x1a\n',
+            chunk(b'IHDR', header),
+            chunk(b'IDAT', zlib.compress(self.buffer.tobytes())),
+            chunk(b'IEND', b''),
+        ))
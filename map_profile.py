@@ -0,0 +1,105 @@
+import collections
+import tracemalloc
+import cProfile
+import pstats
+import time
+import io
+
+
+class Instruments:
+
+    def __init__(self, on_start=None, on_end=None, profile=(),
+                 trace_memory=()):
+        """ Measures the steps of a map. The on_start callback is called with
+            the map and the name of each step before it runs, and on_end with
+            the map and the record of the step once it has finished. Steps
+            named in profile are run under cProfile and steps named in
+            trace_memory have their peak memory traced, both of which slow
+            the step down. Either can be True to cover every step """
+
+        self.on_start = on_start
+        self.on_end = on_end
+        self.profile = profile
+        self.trace_memory = trace_memory
+
+        # The record of each step measured, in the order they finished
+        self.records = list()
+
+    @staticmethod
+    def covers(steps, name):
+        return steps is True or name in steps
+
+    def measure(self, map, name, method, args, kwargs):
+        """ Runs a step of the map, counting what happens to its grids """
+
+        if self.on_start is not None:
+            self.on_start(map, name)
+
+        profiler = None
+        if Instruments.covers(self.profile, name):
+            profiler = cProfile.Profile()
+        tracing = (Instruments.covers(self.trace_memory, name)
+                   and not tracemalloc.is_tracing())
+        if tracing:
+            tracemalloc.start()
+
+        counters = collections.Counter()
+        outer = map.counters
+        map.set_counters(counters)
+        start = time.perf_counter()
+        try:
+            if profiler is not None:
+                result = profiler.runcall(method, map, *args, **kwargs)
+            else:
+                result = method(map, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            map.set_counters(outer)
+            if tracing:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+        record = {'step': name, 'time': elapsed, 'counters': dict(counters)}
+        if tracing:
+            record['peak'] = peak
+        if profiler is not None:
+            record['profile'] = profiler
+        self.records.append(record)
+
+        if self.on_end is not None:
+            self.on_end(map, record)
+        return result
+
+    def totals(self):
+        """ Returns the total time and counters of each step measured """
+
+        totals = dict()
+        for record in self.records:
+            total = totals.setdefault(record['step'], {
+                'runs': 0, 'time': 0.0, 'counters': collections.Counter()})
+            total['runs'] += 1
+            total['time'] += record['time']
+            total['counters'].update(record['counters'])
+        return totals
+
+    def describe(self, limit=10):
+        """ Returns a summary of every step measured, followed by the slowest
+            functions of any steps that were profiled """
+
+        lines = [f"{'step':<20}{'time (s)':>10}  counters"]
+        for record in self.records:
+            counters = [f'{key}={value}' for key, value
+                        in sorted(record['counters'].items())]
+            if 'peak' in record:
+                counters.append(f"peak={record['peak'] / 2**20:.1f}MiB")
+            counters = ', '.join(counters)
+            lines.append(f"{record['step']:<20}{record['time']:>10.4f}"
+                         f"  {counters}")
+
+        for record in self.records:
+            if 'profile' in record:
+                stream = io.StringIO()
+                stats = pstats.Stats(record['profile'], stream=stream)
+                stats.sort_stats('cumulative').print_stats(limit)
+                lines.append(f"\n{record['step']}:\n{stream.getvalue()}")
+        return '\n'.join(lines)
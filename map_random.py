@@ -0,0 +1,128 @@
+import numpy as np
+import random
+import zlib
+
+
+def key_numbers(key):
+    """ Returns the parts of a key as numbers, names are hashed """
+
+    return tuple(part if isinstance(part, int) and part >= 0
+                 else zlib.crc32(repr(part).encode()) for part in key)
+
+
+class Legacy:
+
+    name = 'legacy'
+
+    def __init__(self):
+        """ Draws every number from one random.Random, which is seeded again
+            for each step just as the random module was, so maps are identical
+            to those made before maps had generators of their own. The keys of
+            streams are ignored and steps which do not seed the generator carry
+            on from the step before """
+
+        self.generator = random.Random()
+
+    def copy(self):
+        legacy = Legacy()
+        legacy.setstate(self.getstate())
+        return legacy
+
+    def stream(self, seed, *key):
+        self.generator.seed(seed)
+        return self.generator
+
+    def next_seed(self, seed):
+        return self.generator.randint(0, 2**32-1)
+
+    def getstate(self):
+        return self.generator.getstate()
+
+    def setstate(self, state):
+        self.generator.setstate(state)
+
+
+class Stream:
+
+    # The number of random numbers generated at once
+    block = 4096
+
+    def __init__(self, generator):
+        """ Random numbers from a numpy generator, generated in blocks, with
+            the methods of random.Random which the steps use """
+
+        self.generator = generator
+        self.numbers = list()
+
+    def random(self):
+        if not self.numbers:
+            self.numbers = self.generator.random(Stream.block).tolist()
+        return self.numbers.pop()
+
+    def randint(self, a, b):
+        return a + int(self.random() * (b - a + 1))
+
+    def choice(self, seq):
+        return seq[int(self.random() * len(seq))]
+
+    def shuffle(self, x):
+        """ Shuffles a list, or an array.array, of numbers in place """
+
+        shuffled = np.asarray(x)[self.generator.permutation(len(x))]
+        if isinstance(x, list):
+            x[:] = shuffled.tolist()
+        else:
+            x[:] = type(x)(x.typecode, shuffled.tobytes())
+
+
+class Streams:
+
+    name = 'streams'
+
+    def __init__(self):
+        """ Gives each step a stream of its own, worked out from the seed and
+            a key naming the step or chunk with a counter based generator, so
+            no stream depends on the numbers drawn from another. Numbers are
+            drawn in blocks, which is faster than the random module, but maps
+            differ from those made in legacy mode """
+
+    def copy(self):
+        return self
+
+    def stream(self, seed, *key):
+        sequence = np.random.SeedSequence(seed, spawn_key=key_numbers(key))
+        return Stream(np.random.Generator(np.random.Philox(sequence)))
+
+    def next_seed(self, seed):
+        sequence = np.random.SeedSequence(seed,
+                                          spawn_key=key_numbers(('next',)))
+        return int(sequence.generate_state(1)[0])
+
+    def getstate(self):
+        return None
+
+    def setstate(self, state):
+        pass
+
+
+kinds = {'legacy': Legacy, 'streams': Streams}
+
+
+def generator(stream):
+    """ Returns a numpy generator drawing from a stream, for work done on
+        whole arrays. A legacy stream seeds a new generator from its next
+        numbers, so the same seed still gives the same numbers """
+
+    if isinstance(stream, Stream):
+        return stream.generator
+    return np.random.Generator(np.random.PCG64(stream.getrandbits(128)))
+
+
+def make(rng):
+    """ Returns a generator for the given name, or the generator itself """
+
+    if isinstance(rng, str):
+        if rng not in kinds:
+            raise Exception(f'Unknown random number generator {rng!r}')
+        return kinds[rng]()
+    return rng
@@ -1,110 +1,701 @@
 from map_output import Output
+import map_kernels
+import map_random
+import numpy as np
+import functools
+import itertools
 import random
+import array
+import heapq
 import math
 
 
+@functools.lru_cache()
+def ring_offsets(layers):
+    """ Returns the offsets of the adjacent tiles in each layer, in the order
+        they are found going clockwise from the top left corner of the layer.
+        The table is shared by every tile, so only the offsets for the given
+        number of layers are stored """
+
+    rings = list()
+    for layer in range(1, layers+1):
+        ring = list()
+        for off in range(-layer, layer):
+            ring.append((off, -layer))
+        for off in range(-layer, layer):
+            ring.append((layer, off))
+        for off in range(layer, -layer, -1):
+            ring.append((off, layer))
+        for off in range(layer, -layer, -1):
+            ring.append((-layer, off))
+        rings.append(tuple(ring))
+    return tuple(rings)
+
+
+@functools.lru_cache()
+def land_weights(layers):
+    """ Returns the weight of a collapsed tile in each layer when picking
+        land or water, and the total weight of every layer """
+
+    def a(n):
+        if n == 1:
+            return 1
+        return a(n-1) + n*((n-1)**2)
+
+    weights = tuple(8*(layers-i)*((layers-i)**2) for i in range(layers))
+    return weights, 8*a(layers)
+
+
+@functools.lru_cache()
+def soften_weights(layers):
+    """ Returns the weight of a tile in each layer when softening """
+
+    def a(n):
+        if n == 1:
+            return 1
+        return a(n-1) + 8**(n-1)
+
+    return tuple(a(layers-i) for i in range(layers))
+
+
+def step(method):
+    """ Marks a method of Map as a step of generating a map, so that it can be
+        measured when the map has instruments. Without instruments the step is
+        called straight away """
+
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.instruments is None:
+            return method(self, *args, **kwargs)
+        return self.instruments.measure(self, name, method, args, kwargs)
+
+    return wrapper
+
+
 class Tile:
 
-    def __init__(self, grid, pos, value):
-        """ Describes an individual tile in the grid """
+    __slots__ = ('grid', 'pos', 'x', 'y')
+
+    def __init__(self, grid, pos):
+        """ Describes an individual tile in the grid. Tiles are lightweight
+            views onto the grid's arrays and are only created on demand """
 
         self.grid = grid
         self.pos = pos
         self.x, self.y = pos
-        self.value = value
-
-        self.has_collapsed_adjacent = False
 
     def __repr__(self):
         return f'<Tile {self.pos} {self.value}>'
 
+    def __eq__(self, other):
+        if not isinstance(other, Tile):
+            return NotImplemented
+        return self.grid is other.grid and self.pos == other.pos
+
+    def __hash__(self):
+        return hash((id(self.grid), self.pos))
+
+    @property
+    def value(self):
+        return int(self.grid.values[self.x, self.y])
+
+    @value.setter
+    def value(self, value):
+        self.grid.values[self.x, self.y] = value
+
+    @property
+    def has_collapsed_adjacent(self):
+        return bool(self.grid.flags[self.x, self.y])
+
+    @has_collapsed_adjacent.setter
+    def has_collapsed_adjacent(self, flag):
+        self.grid.flags[self.x, self.y] = flag
+
     def get_tiles(self, layer):
+        """ Returns the adjacent tiles in the given layer """
 
-        tiles = list()
-        x, y = self.pos
         grid = self.grid
-        if y - layer >= 0:
-            for off in range(-layer, layer):
-                if x + off < 0 or x + off > grid.width - 1:
-                    continue
-                tiles.append(grid[x + off][y - layer])
-        if x + layer < grid.width:
-            for off in range(-layer, layer):
-                if y + off < 0 or y + off > grid.height - 1:
-                    continue
-                tiles.append(grid[x + layer][y + off])
-        if y + layer < grid.height:
-            for off in range(layer, -layer, -1):
-                if x + off < 0 or x + off > grid.width - 1:
-                    continue
-                tiles.append(grid[x + off][y + layer])
-        if x - layer >= 0:
-            for off in range(layer, -layer, -1):
-                if y + off < 0 or y + off > grid.height - 1:
-                    continue
-                tiles.append(grid[x - layer][y + off])
-        return tiles
+        return [Tile(grid, pos) for pos in grid.get_tiles(self.x, self.y, layer)]
 
-    def load_adjacent(self, layers=1):
-        """ Finds and stores all adjacent tiles. The importance of layers is to
-            prevent incompatable tiles from being plotted too close to one
-            another """
+    def get_adjacent(self, layers=1):
+        """ Returns the adjacent tiles in each layer. The importance of layers
+            is to prevent incompatable tiles from being plotted too close to
+            one another """
 
-        self.adjacent = list()
-        for layer in range(layers):
-            self.adjacent.append(self.get_tiles(layer+1))
+        return [self.get_tiles(layer+1) for layer in range(layers)]
 
     def collapse(self, value):
-        self.value = value
-        for tile in self.adjacent[0]:
-            tile.has_collapsed_adjacent = True
+        self.grid.collapse(self.x, self.y, value)
+
+
+class RingCounts:
+
+    def __init__(self, grid, layers, weights, values, inner=False,
+                 base=None):
+        """ Counts the tiles of each value, below the given number of values,
+            around every tile of the grid, weighted by the layer they are in,
+            and optionally also unweighted in the first layer alone. The counts
+            are built from the grid once, then kept up to date as tiles
+            collapse by adding and removing a kernel of weights around them.
+            If a base, such as an Upscaled view, is given the grid must not
+            have any collapsed tiles, and tiles count as their value in the
+            base until they collapse.
+
+            The counts have a border the size of the layers, so the kernels
+            never need clipping at the edges of the grid, and single tiles are
+            read through memoryviews, which are much faster than indexing the
+            arrays. They are stored in the smallest type which can hold the
+            total of the kernel """
+
+        self.layers = layers
+        self.values = values
+        self.base = base
+        self.stride = grid.height + 2*layers
+        self.plane = (grid.width + 2*layers)*self.stride
+        shape = (values, grid.width + 2*layers, self.stride)
+
+        size = 2*layers + 1
+        kernel = np.zeros((size, size), dtype=np.int64)
+        for i, ring in enumerate(ring_offsets(layers)):
+            for dx, dy in ring:
+                kernel[layers+dx, layers+dy] = weights[i]
+        dtype = np.uint16 if kernel.sum() < 2**16 else np.int64
+        self.kernel = kernel.astype(dtype)
+        self.weighted = np.zeros(shape, dtype=dtype)
+        self.add_all(grid, self.weighted, self.kernel)
+        self.weighted_view = memoryview(self.weighted.ravel())
+
+        self.inner = None
+        if inner:
+            self.inner_kernel = np.zeros((size, size), dtype=np.uint8)
+            self.inner_kernel[layers-1:layers+2, layers-1:layers+2] = 1
+            self.inner_kernel[layers, layers] = 0
+            self.inner = np.zeros(shape, dtype=np.uint8)
+            self.add_all(grid, self.inner, self.inner_kernel)
+            self.inner_view = memoryview(self.inner.ravel())
+
+    def add_all(self, grid, counts, kernel):
+        """ Adds the kernel around every tile of the grid to the counts """
+
+        for value in range(self.values):
+            if self.base is not None:
+                is_value = self.base.equal(value)
+            else:
+                is_value = grid.values == value
+            for dx, dy in np.argwhere(kernel).tolist():
+                window = counts[value, dx:dx + grid.width, dy:dy + grid.height]
+                np.add(window, kernel[dx, dy], out=window, where=is_value)
+
+    def index(self, x, y):
+        return (x + self.layers)*self.stride + y + self.layers
+
+    def weighted_at(self, x, y):
+        """ Returns the weighted count of each value around a tile """
+
+        i = self.index(x, y)
+        view = self.weighted_view
+        return [view[i + value*self.plane] for value in range(self.values)]
+
+    def inner_at(self, x, y):
+        """ Returns the count of each value in the first layer around a
+            tile """
+
+        i = self.index(x, y)
+        view = self.inner_view
+        return [view[i + value*self.plane] for value in range(self.values)]
+
+    def update(self, x, y, old, new):
+        """ Moves a tile's counts from its old value to its new value """
+
+        if old == -1 and self.base is not None:
+            old = self.base.at(x, y)
+        if old == new:
+            return
+        size = 2*self.layers + 1
+        window = (slice(x, x + size), slice(y, y + size))
+        if 0 <= old < self.values:
+            self.weighted[old][window] -= self.kernel
+            if self.inner is not None:
+                self.inner[old][window] -= self.inner_kernel
+        if 0 <= new < self.values:
+            self.weighted[new][window] += self.kernel
+            if self.inner is not None:
+                self.inner[new][window] += self.inner_kernel
+
+
+class Upscaled:
+
+    def __init__(self, grid, resolution, height, width):
+        """ A view of a grid scaled up by the resolution, so that each tile
+            covers a square of tiles, and cut to the given size. Nothing is
+            stored at the larger size, values are read from the grid as they
+            are needed """
+
+        self.grid = grid
+        self.resolution = resolution
+        self.height = height
+        self.width = width
+        self.view = memoryview(np.ascontiguousarray(grid.values).ravel())
+
+    def at(self, x, y):
+        res = self.resolution
+        return self.view[(x // res)*self.grid.height + y // res]
+
+    def equal(self, value):
+        """ Returns a mask of the tiles with the given value """
+
+        res = self.resolution
+        coarse = self.grid.values == value
+        mask = np.empty((self.width, self.height), dtype=bool)
+        for x_off in range(res):
+            for y_off in range(res):
+                part = mask[x_off::res, y_off::res]
+                part[:] = coarse[:part.shape[0], :part.shape[1]]
+        return mask
+
+    def order(self):
+        """ Returns the flat indices of the tiles in the order of the squares
+            they fall in """
+
+        res = self.resolution
+        height = self.height
+        dtype = np.int32 if self.width*height < 2**31 else np.int64
+        xs = np.arange(self.grid.width, dtype=dtype)[:, None, None, None]*res
+        ys = np.arange(self.grid.height, dtype=dtype)[None, :, None, None]*res
+        x_offs = np.arange(res, dtype=dtype)[None, None, :, None]
+        y_offs = np.arange(res, dtype=dtype)[None, None, None, :]
+        order = (xs + x_offs)*height + ys + y_offs
+        if self.width % res or height % res:
+            inside = (xs + x_offs < self.width) & (ys + y_offs < height)
+            return order[inside]
+        return order.ravel()
+
+
+class Domains:
+
+    def __init__(self, grid, layers, values):
+        """ Keeps the values each tile can still take as a bitmask. A tile in
+            the nth layer around a collapsed tile can differ from it by at most
+            n, so each collapse narrows the masks of the tiles around it. Masks
+            are only ever narrowed, tiles are not expected to be uncollapsed """
+
+        self.layers = layers
+        self.masks = np.full((grid.width, grid.height), 2**values - 1,
+                             dtype=np.uint8)
+
+        # The masks to apply around a tile collapsed to each value, indexed by
+        # the offset from the tile plus the layers, the tile itself is left
+        offsets = np.arange(-layers, layers+1)
+        layer = np.maximum(abs(offsets)[:, None], abs(offsets)[None, :])
+        self.kernels = list()
+        for value in range(values):
+            kernel = np.zeros(layer.shape, dtype=np.uint8)
+            for possibility in range(values):
+                allowed = abs(possibility - value) <= layer
+                kernel |= allowed.astype(np.uint8) << possibility
+            kernel[layers, layers] = 2**values - 1
+            self.kernels.append(kernel)
+
+        # The values left in each mask, in ascending order
+        self.choices = [[value for value in range(values) if mask >> value & 1]
+                        for mask in range(2**values)]
+
+        for x, y in np.argwhere(grid.values != -1).tolist():
+            self.update(x, y, -1, int(grid.values[x, y]))
+
+    def update(self, x, y, old, new):
+        """ Narrows the masks around a tile collapsed to the new value """
+
+        if new == -1:
+            return
+        layers = self.layers
+        width, height = self.masks.shape
+        x1 = max(x - layers, 0)
+        y1 = max(y - layers, 0)
+        x2 = min(x + layers + 1, width)
+        y2 = min(y + layers + 1, height)
+        kernel = self.kernels[new]
+        self.masks[x1:x2, y1:y2] &= kernel[x1-x+layers:x2-x+layers,
+                                           y1-y+layers:y2-y+layers]
+
+    def possibilities(self, x, y):
+        return self.choices[self.masks[x, y]]
+
+
+class Column:
+
+    __slots__ = ('grid', 'x')
+
+    def __init__(self, grid, x):
+        """ A column of tiles in the grid """
+
+        self.grid = grid
+        self.x = x
+
+    def __len__(self):
+        return self.grid.height
+
+    def __getitem__(self, y):
+        """ Returns a tile at a given position in the column """
+
+        if not -self.grid.height <= y < self.grid.height:
+            raise IndexError('tile index out of range')
+        return Tile(self.grid, (self.x, y % self.grid.height))
+
+
+class Frontier:
+
+    def __init__(self, grid, tiles):
+        """ Schedules a shuffled list of tiles, given as flat indices into the
+            grid, for collapse. Tiles with a collapsed adjacent tile are taken
+            first in the order of the list, otherwise the last remaining tile
+            in the list is taken """
+
+        size = grid.width * grid.height
+        dtype = np.int32 if size < 2**31 else np.int64
+        self.grid = grid
+        self.tiles = np.array(tiles, dtype=dtype)
+        self.index = np.full(size, -1, dtype=dtype)
+        self.index[self.tiles] = np.arange(len(tiles))
+        self.pending = bytearray(b'\x01') * len(tiles)
+        self.remaining = len(tiles)
+        self.last = len(tiles) - 1
+
+        # Indices of pending tiles with a collapsed adjacent tile, the list is
+        # already sorted so is a valid heap
+        flags = grid.flags.ravel()[self.tiles]
+        self.ready = np.flatnonzero(flags).tolist()
+
+    def __len__(self):
+        return self.remaining
+
+    def push(self, pos):
+        """ Marks the tile at the given flat index as having a collapsed
+            adjacent tile """
+
+        i = int(self.index[pos])
+        if i != -1 and self.pending[i]:
+            heapq.heappush(self.ready, i)
+
+    def take(self, i):
+        """ Removes the tile at the given index from the pool """
+
+        self.pending[i] = False
+        self.remaining -= 1
+        return Tile(self.grid, divmod(int(self.tiles[i]), self.grid.height))
+
+    def pop(self):
+        """ Returns the next tile to collapse """
+
+        counters = self.grid.counters
+        while self.ready:
+            i = heapq.heappop(self.ready)
+            if self.pending[i]:
+                if counters is not None:
+                    counters['frontier'] += 1
+                return self.take(i)
+
+        if counters is not None:
+            counters['fallback'] += 1
+        while not self.pending[self.last]:
+            self.last -= 1
+        return self.take(self.last)
 
 
 class Grid:
 
-    def __init__(self, height, width, grid=None, default=-1):
-        """ Creates a grid of tiles """
+    def __init__(self, height, width, values=None, default=-1,
+                 counters=None):
+        """ Creates a grid of tiles, the values and collapsed adjacent flags of
+            the tiles are stored in arrays indexed by x then y. Counters, when
+            given, count what happens to the grid while it is generated """
 
         self.height = height
         self.width = width
 
-        if grid is None:
-            grid = list()
-            for x in range(width):
-                grid.append(list())
-                for y in range(height):
-                    tile = Tile(self, (x, y), default)
-                    grid[-1].append(tile)
-        self.grid = grid
+        if values is None:
+            values = np.full((width, height), default, dtype=np.int8)
+        self.values = values
+        self.flags = np.zeros((width, height), dtype=bool)
+
+        # Set while tiles are being collapsed in order
+        self.frontier = None
+
+        # Objects kept up to date as tiles collapse
+        self.observers = list()
+
+        self.counters = counters
+        if counters is not None:
+            counters['grids'] += 1
 
     def copy(self):
         """ Creates a copy of the grid """
 
-        gridCopy = list()
-        for col in self.grid:
-            gridCopy.append(list())
-            for tile in col:
-                tileCopy = Tile(gridCopy, tile.pos, tile.value)
-                tileCopy.has_collapsed_adjacent = tile.has_collapsed_adjacent
-                if hasattr(tile, "adjacent"):
-                    tileCopy.adjacent = tile.adjacent
-                gridCopy[-1].append(tileCopy)
-        return Grid(self.height, self.width, gridCopy)
+        gridCopy = Grid(self.height, self.width, self.values.copy())
+        gridCopy.flags = self.flags.copy()
+        return gridCopy
 
-    def __getitem__(self, row):
-        """ Returns a tile at a given position """
+    def window(self, x1, y1, x2, y2):
+        """ Returns a grid of the tiles between the given positions, which
+            shares their values with this grid but has flags of its own """
+
+        values = self.values[x1:x2, y1:y2]
+        width, height = values.shape
+        return Grid(height, width, values, counters=self.counters)
 
-        return self.grid[row]
+    def __len__(self):
+        return self.width
+
+    def __getitem__(self, row):
+        """ Returns a column of tiles at a given position """
+
+        if not -self.width <= row < self.width:
+            raise IndexError('column index out of range')
+        return Column(self, row % self.width)
+
+    def tile(self, pos):
+        """ Returns the tile at the given flat index """
+
+        return Tile(self, divmod(pos, self.height))
+
+    def get_tiles(self, x, y, layer):
+        """ Returns the positions of the tiles in the given layer around a
+            position, clipped to the bounds of the grid """
+
+        width = self.width
+        height = self.height
+        positions = list()
+        for dx, dy in ring_offsets(layer)[-1]:
+            ax = x + dx
+            ay = y + dy
+            if 0 <= ax < width and 0 <= ay < height:
+                positions.append((ax, ay))
+        return positions
+
+    def collapse(self, x, y, value):
+        """ Collapses the tile at the given position to a value and marks its
+            adjacent tiles """
+
+        if self.counters is not None:
+            self.counters['collapsed'] += 1
+        if self.observers:
+            old = int(self.values[x, y])
+            for observer in self.observers:
+                observer.update(x, y, old, value)
+        self.values[x, y] = value
+        flags = self.flags
+        frontier = self.frontier
+        for ax in range(max(x - 1, 0), min(x + 2, self.width)):
+            for ay in range(max(y - 1, 0), min(y + 2, self.height)):
+                if (ax != x or ay != y) and not flags[ax, ay]:
+                    flags[ax, ay] = True
+                    if frontier is not None:
+                        frontier.push(ax*self.height + ay)
+
+    def schedule(self, tiles):
+        """ Starts collapsing the given shuffled list of flat indices """
+
+        self.frontier = Frontier(self, tiles)
+        return self.frontier
 
     def find_next(self, tiles):
         """ Finds the next tile to collapse """
 
-        for tile in tiles:
-            if tile.has_collapsed_adjacent:
-                tiles.remove(tile)
-                return tile
+        tile = tiles.pop()
+        if not tiles:
+            self.frontier = None
+        return tile
+
+
+class Event:
+
+    def __init__(self, kind, positions=None, values=None, tiles=None,
+                 grid=None, resolution=1, color=None):
+        """ Describes what a step has done to the map, so it can be output.
+            Relief and temperature events hold the positions and values of the
+            tiles collapsed, as they were when the event was given, and the
+            tiles themselves. Map events hold the whole landmass and plot
+            events the positions to be plotted in a color """
+
+        self.kind = kind
+        self.positions = positions
+        self.values = values
+        self.tiles = tiles
+        self.grid = grid
+        self.resolution = resolution
+        self.color = color
+
+    def __repr__(self):
+        count = len(self.positions) if self.positions is not None else 'all'
+        return f'<Event {self.kind} {count}>'
+
+
+class EventBatch:
+
+    def __init__(self, kind, size=1024, window=None, **details):
+        """ Collects tiles into events of the given kind. Adding a tile returns
+            whether enough tiles have been collected to be taken as an event,
+            a size of None never fills up. Tiles from a window of a grid are
+            moved back onto the grid, given as the grid and the position of
+            the window """
+
+        self.kind = kind
+        self.size = size
+        self.window = window
+        self.details = details
+        self.tiles = list()
+
+    def __bool__(self):
+        return bool(self.tiles)
+
+    def add(self, tile):
+        if self.window is not None:
+            grid, x, y = self.window
+            tile = Tile(grid, (tile.x + x, tile.y + y))
+        self.tiles.append(tile)
+        return self.size is not None and len(self.tiles) >= self.size
+
+    def take(self):
+        """ Returns the tiles collected as an event and starts again """
+
+        tiles, self.tiles = self.tiles, list()
+        positions = [tile.pos for tile in tiles]
+        values = [tile.value for tile in tiles]
+        return Event(self.kind, positions, values, tiles, **self.details)
+
+
+class History:
+
+    # The attributes of a map which make up its state
+    attributes = ('landmass', 'heatmap', 'resolution', 'elevation', 'terrain',
+                  'terrain_options')
+
+    def __init__(self, limit=None):
+        """ Stores the states of a map. Only the latest state is stored in
+            full, every other state is stored as the changes needed to turn the
+            state after it back into it. The number of states kept can be
+            limited, the oldest states are forgotten first """
+
+        self.limit = limit
+        self.seeds = list()
+        self.patches = list()
+        self.latest = None
+
+    def __len__(self):
+        return len(self.seeds)
+
+    @staticmethod
+    def snapshot(map):
+        """ Returns the state of a map, with copies of its grids' values """
+
+        state = dict()
+        for name in History.attributes:
+            if hasattr(map, name):
+                value = getattr(map, name)
+                if isinstance(value, Grid):
+                    value = value.values.copy()
+                state[name] = value
+        return state
+
+    @staticmethod
+    def diff(new, old):
+        """ Returns the changes which turn the new state into the old one """
+
+        patch = dict()
+        for name in History.attributes:
+            if name not in old:
+                if name in new:
+                    patch[name] = ('unset',)
+                continue
+            value = old[name]
+            new_value = new.get(name)
+            if (isinstance(value, np.ndarray)
+                    and isinstance(new_value, np.ndarray)
+                    and value.shape == new_value.shape):
+                changed = np.flatnonzero(new_value != value)
+                # Positions take up more space than values, so grids with many
+                # changes are stored in full
+                if changed.size*5 < value.size:
+                    if value.size < 2**31:
+                        changed = changed.astype(np.int32)
+                    if changed.size:
+                        patch[name] = ('changes', changed, value.flat[changed])
+                    continue
+            elif value is new_value:
+                continue
+            patch[name] = ('set', value)
+        return patch
+
+    @staticmethod
+    def apply(state, patch):
+        """ Returns the state with the changes applied """
+
+        state = dict(state)
+        for name, change in patch.items():
+            if change[0] == 'unset':
+                del state[name]
+            elif change[0] == 'set':
+                state[name] = change[1]
+            else:
+                _, changed, values = change
+                state[name] = state[name].copy()
+                state[name].flat[changed] = values
+        return state
+
+    def append(self, map):
+        """ Saves the current state of the map """
 
-        return tiles.pop()
+        state = History.snapshot(map)
+        if self.latest is not None:
+            self.patches[-1] = History.diff(state, self.latest)
+        self.seeds.append(map.seed)
+        self.patches.append(None)
+        self.latest = state
+
+        if self.limit is not None and len(self) > self.limit:
+            del self.seeds[0]
+            del self.patches[0]
+
+    def state(self, index=-1):
+        """ Returns the given state, rebuilt from the latest state """
+
+        index = range(len(self))[index]
+        state = self.latest
+        for patch in reversed(self.patches[index:-1]):
+            state = History.apply(state, patch)
+        return state
+
+    def truncate(self, index):
+        """ Removes all states from and including the given state """
+
+        index = slice(index, None).indices(len(self))[0]
+        if index == len(self):
+            return
+        if index == 0:
+            self.latest = None
+        else:
+            self.latest = self.state(index - 1)
+        del self.seeds[index:]
+        del self.patches[index:]
+        if self.patches:
+            self.patches[-1] = None
+
+    def restore(self, map, index=-1):
+        """ Sets the map to the given state """
+
+        state = self.state(index)
+        for name in History.attributes:
+            if name not in state:
+                if hasattr(map, name):
+                    delattr(map, name)
+                continue
+            value = state[name]
+            if isinstance(value, np.ndarray):
+                width, height = value.shape
+                value = Grid(height, width, value.copy())
+            setattr(map, name, value)
 
 
 class Map:
@@ -112,12 +703,31 @@ class Map:
     water = 0
     land = 1
 
+    # Values of the terrain beyond the landmass, the heights of mountains
+    # follow on from the lowest
+    lake = 2
+    mountain = 4
+
     layers = 2 # Can be modified
     climates = 5 # Must be constant
 
-    def __init__(self, height, width, seed=None, output=Output()):
+    backends = ('numpy', 'python')
+    orders = ('tiles', 'rounds')
+
+    def __init__(self, height, width, seed=None, output=None,
+                 backend='numpy', max_states=None, instruments=None,
+                 rng='legacy', order='tiles'):
         """ Creates a new map with the given height and width, seed and output
-            object """
+            object. The backend chooses whether the passes which only look at
+            adjacent tiles run on whole arrays or tile by tile, and the number
+            of states kept to be restored can be limited. Instruments, such as
+            map_profile.Instruments, are told about each step. The random
+            number generator is 'legacy' or 'streams', see map_random.
+
+            The order chooses how the landmass and softened heatmap collapse,
+            'tiles' collapses one tile at a time in a shuffled order, 'rounds'
+            collapses many tiles at once on whole arrays, which releases the
+            GIL but gives different maps with more land """
 
         # Dimensions of the map
         self.height = height
@@ -129,28 +739,82 @@ class Map:
             seed = random.randint(0, 2**32-1)
         self.seed = seed
 
-        # Stores an object to output the map
+        # Each map draws from a generator of its own rather than the random
+        # module, so maps do not disturb each other
+        self.rng = map_random.make(rng)
+
+        # Stores an object to output the map, every map has an output of its
+        # own so that maps can be generated at once on different threads
+        if output is None:
+            output = Output()
         self.output = output
 
+        if backend not in Map.backends:
+            raise Exception(f'Unknown backend {backend!r}')
+        self.backend = backend
+
+        if order not in Map.orders:
+            raise Exception(f'Unknown order {order!r}')
+        self.order = order
+
         # Stores the states of the map so actions can be undone without
         # regenerating each state of the map
-        self.states = list()
+        self.states = History(max_states)
+
+        # Counters are only set while an instrumented step runs
+        self.instruments = instruments
+        self.counters = None
+
+        # Whether the output has an outline of the landmass to keep up to date
+        self.outlined = False
+
+    def set_counters(self, counters):
+        """ Sets the counters which the map and every one of its grids count
+            into, grids keep counting into the counters they are given even
+            after the step which created them has finished """
+
+        self.counters = counters
+        for name in ('landmass', 'heatmap', 'elevation', 'terrain'):
+            grid = getattr(self, name, None)
+            if grid is not None:
+                grid.counters = counters
 
     def copy(self):
         """ Creates a copy of the map """
 
-        map = Map(self.height, self.height, self.seed, self.output)
+        map = Map(self.height, self.width, self.seed, self.output,
+                  self.backend, rng=self.rng.copy(), order=self.order)
         if hasattr(self, 'landmass'):
             map.landmass = self.landmass.copy()
         if hasattr(self, 'heatmap'):
             map.heatmap = self.heatmap.copy()
+        if hasattr(self, 'resolution'):
+            map.resolution = self.resolution
+        if hasattr(self, 'terrain'):
+            map.elevation = self.elevation.copy()
+            map.terrain = self.terrain.copy()
+            map.terrain_options = self.terrain_options
         return map
 
+    def save(self, path):
+        """ Saves the map to a file, see map_format """
+
+        import map_format
+        map_format.save(self, path)
+
+    @staticmethod
+    def load(path, output=None):
+        """ Loads a map from a file, its grids are read from the file as
+            they are used """
+
+        import map_format
+        return map_format.load(path, output)
+
     def save_state(self):
         """ Saves the current state of the map """
 
-        self.states.append(self.copy())
-        self.seed = random.randint(0, 2**32-1)
+        self.states.append(self)
+        self.seed = self.rng.next_seed(self.seed)
 
     def restore_state(self, index=-1):
         """ Restores the map to the given state """
@@ -158,24 +822,186 @@ class Map:
         # # Resets the seed if the state does not share the same seed with the
         # # current map
         # if self.states[index].seed != self.seed:
-        seed = self.states[index].seed
+        seed = self.states.seeds[index]
 
         # Remove all states from and including the given state
-        del self.states[index:]
+        self.states.truncate(index)
 
         if self.states:
-            self.__dict__ = self.states[-1].__dict__
+            self.states.restore(self)
             self.seed = seed
             if hasattr(self, "landmass"):
                 self.output.map_relief(self.landmass)
         else:
-            new_map = Map(self.height, self.width, seed, self.output)
+            new_map = Map(self.height, self.width, seed, self.output,
+                          self.backend, self.states.limit,
+                          self.instruments, self.rng, self.order)
             self.__dict__ = new_map.__dict__
             self.output.clear()
 
+        self.output.flush()
+
+    @staticmethod
+    def pick_land(tile, control, counts, rng, counters=None):
+        """ Picks a land or water value for the given tile, from the counts of
+            the collapsed tiles around it """
+
+        if counters is not None:
+            counters['draws'] += 1
+
+        weighted = counts.weighted_at(tile.x, tile.y)
+        water = weighted[Map.water]
+        land = weighted[Map.land]
+        _, total = land_weights(Map.layers)
+
+        chance = rng.randint(1, control)
+        if chance == 1:
+            return Map.water
+        elif chance == 2:
+            return Map.land
+
+        if counters is not None:
+            counters['draws'] += 1
+        chance = rng.randint(1, total)
+        if chance <= water:
+            return Map.water
+        elif chance <= water + land:
+            return Map.land
+
+        inner = counts.inner_at(tile.x, tile.y)
+        inner_water = inner[Map.water]
+        inner_land = inner[Map.land]
+        if counters is not None:
+            counters['draws'] += 1
+        chance = rng.randint(1, 8)
+        if chance <= inner_water:
+            return Map.water
+        elif chance <= inner_water + inner_land:
+            return Map.land
+
+        if counters is not None:
+            counters['draws'] += 1
+        chance = rng.randint(1, water + land)
+        if chance <= water:
+            return Map.water
+        elif chance <= water + land:
+            return Map.land
+
+    @staticmethod
+    def iter_collapse_land(grid, tiles, control, rng, relief=None,
+                           rounds=False):
+        """ Collapses the scheduled tiles of a landmass to land or water,
+            yielding the relief batch each time it fills. In rounds the order
+            of the tiles is not followed, many tiles are collapsed at once on
+            whole arrays instead """
+
+        if rounds:
+            pending = np.zeros(grid.width*grid.height, dtype=bool)
+            pending[tiles.tiles[np.frombuffer(tiles.pending, dtype=bool)]] = \
+                True
+            pending = pending.reshape(grid.width, grid.height)
+            weights, total = land_weights(Map.layers)
+            values = grid.values
+            rounds = map_kernels.collapse_land(
+                values, pending, map_random.generator(rng), control, weights,
+                total, Map.land, Map.water)
+            yield from Map.iter_collapsed(grid, values, rounds, relief)
+            grid.frontier = None
+            return
+
+        weights, _ = land_weights(Map.layers)
+        counts = RingCounts(grid, Map.layers, weights, 2, inner=True)
+        grid.observers.append(counts)
+        while tiles:
+            tile = grid.find_next(tiles)
+            tile.collapse(Map.pick_land(tile, control, counts, rng,
+                                        grid.counters))
+            if relief is not None and relief.add(tile):
+                yield relief.take()
+        grid.observers.remove(counts)
+
+    @staticmethod
+    def iter_collapsed(grid, values, batches, batch=None):
+        """ Sets the tiles collapsed by an array kernel, given as batches of
+            positions whose values are taken from the values, on the grid,
+            yielding the event batch each time it fills. Most of the work is
+            done by numpy, which releases the GIL, so maps on different
+            threads are generated at once """
+
+        counters = grid.counters
+        for xs, ys in batches:
+            if values is not grid.values:
+                grid.values[xs, ys] = values[xs, ys]
+            if counters is not None:
+                counters['collapsed'] += len(xs)
+                counters['draws'] += len(xs)
+            if batch is None:
+                continue
+            for pos in zip(xs.tolist(), ys.tolist()):
+                if batch.add(Tile(grid, pos)):
+                    yield batch.take()
+
+    @staticmethod
+    def collapse_land(grid, tiles, control, rng, rounds=False):
+        """ Collapses the scheduled tiles of a landmass to land or water """
+
+        for _ in Map.iter_collapse_land(grid, tiles, control, rng,
+                                        rounds=rounds):
+            pass
+
+    def output_events(self, events):
+        """ Passes the events of a step to the output, then flushes it """
+
+        for event in events:
+            if event.kind == 'relief':
+                self.output.tiles_relief(event.tiles)
+            elif event.kind == 'temperature':
+                self.output.overlay_temperatures(event.tiles, self.landmass,
+                                                 event.resolution)
+            elif event.kind == 'map':
+                self.output.map_relief(event.grid)
+            elif event.kind == 'plot':
+                self.output.plot_tiles(event.positions, event.color)
+        self.output.flush()
+
+    def run_step(self, name, kwargs=None, progress=None):
+        """ Runs the named step with the given arguments. If progress is given
+            it is called with the name of the step and no tiles as the step
+            starts, then with the number of tiles in each event of the step.
+            Either way the step is measured if the map has instruments """
+
+        kwargs = kwargs or dict()
+        if progress is None:
+            getattr(self, name)(**kwargs)
+            return
+
+        def report(events):
+            for event in events:
+                count = len(event.positions) if event.positions else 0
+                if event.kind == 'map':
+                    count = event.values.size
+                progress(name, count)
+                yield event
+
+        def run(map, **kwargs):
+            progress(name, 0)
+            map.output_events(report(getattr(map, 'iter_' + name)(**kwargs)))
+
+        if self.instruments is None:
+            run(self, **kwargs)
+        else:
+            self.instruments.measure(self, name, run, (), kwargs)
+
+    @step
     def generate_landmass(self, waterborder=4, control=10000):
         """ Generates land using wave function collapse """
 
+        self.output_events(self.iter_generate_landmass(waterborder, control))
+
+    def iter_generate_landmass(self, waterborder=4, control=10000):
+        """ Generates land using wave function collapse, yielding batches of
+            the tiles collapsed """
+
         def in_bounds(x, y):
             """ Returns whether the given position is inside the water
                 border """
@@ -184,132 +1010,137 @@ class Map:
                 if y >= waterborder and y < self.height - waterborder:
                     return True
 
-        def random_coords(x1, y1, x2, y2):
-            """ Returns a random coordinate within the given range """
-
-            x = random.randint(x1, x2)
-            y = random.randint(y1, y2)
-            return x, y
-
-        def pick_value(tile, control):
-            """ Picks a value for the given tile """
-
-            def a(n):
-                if n == 1:
-                    return 1
-                return a(n-1) + n*((n-1)**2)
-
-            water = [[0 for i in range(Map.layers)], 0]
-            land = [[0 for i in range(Map.layers)], 0]
-            total = 8*a(Map.layers)
-            for i in range(Map.layers):
-                for adjacent in tile.adjacent[i]:
-                    if adjacent.value == Map.water:
-                        water[0][i] += 1
-                        water[1] += 8*(Map.layers-i)*((Map.layers-i)**2)
-                    elif adjacent.value == Map.land:
-                        land[0][i] += 1
-                        land[1] += 8*(Map.layers-i)*((Map.layers-i)**2)
-
-            chance = random.randint(1, control)
-            if chance == 1:
-                return Map.water
-            elif chance == 2:
-                return Map.land
-
-            chance = random.randint(1, total)
-            if chance <= water[1]:
-                return Map.water
-            elif chance <= water[1] + land[1]:
-                return Map.land
-
-            chance = random.randint(1, 8)
-            if chance <= water[0][0]:
-                return Map.water
-            elif chance <= water[0][0] + land[0][0]:
-                return Map.land
-
-            chance = random.randint(1, water[1] + land[1])
-            if chance <= water[1]:
-                return Map.water
-            elif chance <= water[1] + land[1]:
-                return Map.land
-
-        random.seed(self.seed)
-        self.landmass = Grid(self.height, self.width)
+        rng = self.rng.stream(self.seed, 'generate_landmass')
+        self.landmass = Grid(self.height, self.width, counters=self.counters)
+        relief = EventBatch('relief')
 
         # Creates a list of all tiles in the grid and shuffles it
         tiles = list()
         for x in range(self.width):
             for y in range(self.height):
                 # If the tile is out of bounds, it is collapses to water
-                tile = self.landmass[x][y]
-                tile.load_adjacent(Map.layers)
                 if not in_bounds(x, y):
+                    tile = self.landmass[x][y]
                     tile.collapse(Map.water)
-                    self.output.tile_relief(tile)
+                    if relief.add(tile):
+                        yield relief.take()
                 else:
-                    tiles.append(tile)
-        random.shuffle(tiles)
-
-        # Chooses a number of tiles that will be automatically determined to be
-        # land and water
-        landpoints = random.randint(2, 10)
-        waterpoints = random.randint(0, 2)
+                    tiles.append(x*self.height + y)
+        rng.shuffle(tiles)
+        tiles = self.landmass.schedule(tiles)
 
         # The range of coordinates for the tiles that start off as land
         # and water
         off = waterborder
         ranges = (off, off, self.width-off, self.height-off)
+        yield from Map.iter_place_points(self.landmass, *ranges, rng, relief)
 
-        for i in range(landpoints):
-            while True:
-                x, y = random_coords(*ranges)
-                if self.landmass[x][y].value == -1:
-                    break
-            tile = self.landmass[x][y]
-            tile.collapse(Map.land)
-            self.output.tile_relief(tile)
-
-        for i in range(waterpoints):
-            while True:
-                x, y = random_coords(*ranges)
-                if self.landmass[x][y].value == -1:
-                    break
-            tile = self.landmass[x][y]
-            tile.collapse(Map.water)
-            self.output.tile_relief(tile)
-
-        while tiles:
-            tile = self.landmass.find_next(tiles)
-            tile.collapse(pick_value(tile, control))
-            self.output.tile_relief(tile)
+        yield from Map.iter_collapse_land(self.landmass, tiles, control, rng,
+                                          relief, self.order == 'rounds')
 
+        if relief:
+            yield relief.take()
         self.save_state()
 
-    def remove_lone_tiles(self, threshold=0):
-        """ Removes tiles that are surrounded by tiles of the opposite value """
+    @staticmethod
+    def iter_place_points(grid, x1, y1, x2, y2, rng, relief):
+        """ Collapses a few random uncollapsed tiles between the given
+            positions, inclusive, to land and water for the rest of the
+            landmass to grow from, yielding the relief batch each time it
+            fills """
 
+        # Chooses a number of tiles that will be automatically determined to be
+        # land and water
+        landpoints = rng.randint(2, 10)
+        waterpoints = rng.randint(0, 2)
+
+        # There may be fewer tiles left to choose from than points
+        free = int((grid.values[x1:x2+1, y1:y2+1] == -1).sum())
+
+        points = ((Map.land, landpoints), (Map.water, waterpoints))
+        for value, count in points:
+            for i in range(min(count, free)):
+                while True:
+                    x = rng.randint(x1, x2)
+                    y = rng.randint(y1, y2)
+                    if x < grid.width and y < grid.height \
+                            and grid.values[x, y] == -1:
+                        break
+                tile = grid[x][y]
+                tile.collapse(value)
+                free -= 1
+                if relief.add(tile):
+                    yield relief.take()
+
+    @step
+    def remove_lone_tiles(self, threshold=0, sequential=True):
+        """ Removes tiles that are surrounded by tiles of the opposite value.
+            When sequential, tiles see the tiles removed before them, otherwise
+            every tile is checked against the landmass as it was """
+
+        self.output_events(self.iter_remove_lone_tiles(threshold, sequential))
+
+    def iter_remove_lone_tiles(self, threshold=0, sequential=True):
+        """ Removes lone tiles, yielding batches of the tiles swapped """
+
+        if self.backend == 'numpy':
+            values = self.landmass.values
+            new_values = map_kernels.remove_lone_tiles(
+                values, threshold, Map.land, Map.water, sequential)
+            changed = np.argwhere(new_values != values).tolist()
+            values[:] = new_values
+            if self.counters is not None:
+                self.counters['collapsed'] += len(changed)
+            relief = EventBatch('relief', size=None)
+            for x, y in changed:
+                relief.add(self.landmass[x][y])
+            yield relief.take()
+            self.save_state()
+            return
+
+        relief = EventBatch('relief')
+
+        landmass = self.landmass if sequential else self.landmass.copy()
         for x in range(self.width):
             for y in range(self.height):
                 count = 0
                 tile = self.landmass[x][y]
-                for adjacent in tile.adjacent[0]:
+                for adjacent in landmass[x][y].get_tiles(1):
                     if adjacent.value == tile.value:
                         count += 1
                 if count <= threshold:
                     if tile.value == Map.land:
                         tile.collapse(Map.water)
-                        self.output.tile_relief(tile)
                     elif tile.value == Map.water:
                         tile.collapse(Map.land)
-                        self.output.tile_relief(tile)
+                    else:
+                        continue
+                    if relief.add(tile):
+                        yield relief.take()
 
+        if relief:
+            yield relief.take()
         self.save_state()
 
+    @step
     def centre_landmass(self):
         """ Positions the landmass in the centre of the map """
 
+        self.output_events(self.iter_centre_landmass())
+
+    def iter_centre_landmass(self):
+        """ Positions the landmass in the centre of the map, yielding the
+            tiles which changed """
+
+        if self.backend == 'numpy':
+            values = map_kernels.centre_landmass(
+                self.landmass.values, Map.land, Map.water)
+            self.landmass = Grid(self.height, self.width, values,
+                                 counters=self.counters)
+            yield Event('map', values=values.copy(), grid=self.landmass)
+            self.save_state()
+            return
+
         # Finds the bounds of the landmass
         x1 = self.width // 2
         y1 = self.height // 2
@@ -333,41 +1164,36 @@ class Map:
         dx = (self.width - (x2 - x1)) // 2 - x1
         dy = (self.height - (y2 - y1)) // 2 - y1
 
-        new_landmass = Grid(self.height, self.width, default=Map.water)
+        new_landmass = Grid(self.height, self.width, default=Map.water,
+                            counters=self.counters)
+        relief = EventBatch('relief')
         for x in range(self.width):
             for y in range(self.height):
                 if self.landmass[x][y].value == Map.land:
                     new_landmass[x+dx][y+dy].value = Map.land
-                    self.output.tile_relief(new_landmass[x+dx][y+dy])
+                    if relief.add(new_landmass[x+dx][y+dy]):
+                        yield relief.take()
         for x in range(self.width):
             for y in range(self.height):
                 if self.landmass[x][y].value == Map.land:
                     if new_landmass[x][y].value == Map.water:
-                        self.output.tile_relief(new_landmass[x][y])
+                        if relief.add(new_landmass[x][y]):
+                            yield relief.take()
 
+        if relief:
+            yield relief.take()
         self.landmass = new_landmass
         self.save_state()
 
+    @step
     def generate_heatmap(self, resolution=4, control=10000):
         """ Generates a heatmap using the landmass """
 
-        def eliminate_possibilities(tile):
-            """ Eliminates possibilities for the tile based on its neighbours """
+        self.output_events(self.iter_generate_heatmap(resolution, control))
 
-            possibilities = [i for i in range(Map.climates)]
-            for i, layer in enumerate(tile.adjacent):
-                for adjacent in layer:
-                    value = adjacent.value
-                    if value == -1:
-                        continue
-                    for possibility in possibilities.copy():
-                        if possibility > value + (i + 1):
-                            possibilities.remove(possibility)
-                        elif possibility < value - (i + 1):
-                            possibilities.remove(possibility)
-                    if len(possibilities) == 1:
-                        return possibilities
-            return possibilities
+    def iter_generate_heatmap(self, resolution=4, control=10000):
+        """ Generates a heatmap using the landmass, yielding batches of the
+            tiles collapsed """
 
         if not hasattr(self, 'landmass'):
             raise Exception('Landmass has not been generated')
@@ -376,98 +1202,400 @@ class Map:
         width = math.ceil(self.width / resolution)
         height = math.ceil(self.height / resolution)
 
-        random.seed(self.seed)
-        self.heatmap = Grid(height, width)
+        rng = self.rng.stream(self.seed, 'generate_heatmap')
+        self.heatmap = Grid(height, width, counters=self.counters)
         self.resolution = resolution
 
-        tiles = list()
-        for x in range(width):
-            for y in range(height):
-                tile = self.heatmap[x][y]
-                tile.load_adjacent(Map.climates) # 5
-                tiles.append(tile)
-        random.shuffle(tiles)
+        tiles = list(range(width*height))
+        rng.shuffle(tiles)
+        tiles = self.heatmap.schedule(tiles)
 
-        tile = tiles.pop()
+        # Collapsed tiles narrow the climates of the tiles within as many
+        # layers around them as there are climates
+        domains = Domains(self.heatmap, Map.climates, Map.climates)
+        self.heatmap.observers.append(domains)
+
+        temperature = EventBatch('temperature', resolution=resolution)
+
+        tile = self.heatmap.find_next(tiles)
         tile.collapse(2)
-        self.output.overlay_temperature(tile, self.landmass, resolution)
+        temperature.add(tile)
 
         while tiles:
             tile = self.heatmap.find_next(tiles)
-            possibilities = eliminate_possibilities(tile)
-            tile.collapse(random.choice(possibilities))
-            self.output.overlay_temperature(tile, self.landmass, resolution)
-
+            possibilities = domains.possibilities(tile.x, tile.y)
+            if self.counters is not None:
+                self.counters['draws'] += 1
+            tile.collapse(rng.choice(possibilities))
+            if temperature.add(tile):
+                yield temperature.take()
+
+        self.heatmap.observers.remove(domains)
+        if temperature:
+            yield temperature.take()
         self.save_state()
 
+    @staticmethod
+    def pick_climate(tile, counts, rng, counters=None):
+        """ Returns a new climate for the tile, drawn in the same way as
+            random.choices would from the weighted counts of each climate
+            around the tile """
+
+        if counters is not None:
+            counters['draws'] += 1
+        frequency = counts.weighted_at(tile.x, tile.y)
+        cumulative = list(itertools.accumulate(frequency))
+        chance = rng.random() * (cumulative[-1] + 0.0)
+        for value in range(Map.climates - 1):
+            if chance < cumulative[value]:
+                return value
+        return Map.climates - 1
+
+    @step
     def soften_heatmap(self):
         """ Softens the heatmap """
 
-        def pick_value(tile):
-            """ Returns a new value for the tile """
-
-            def a(n):
-                if n == 1:
-                    return 1
-                return a(n-1) + 8**(n-1)
-
-            frequency = [0 for i in range(Map.climates)]
-            for i, layer in enumerate(tile.adjacent):
-                for adjacent in layer:
-                    value = adjacent.value
-                    if value == -1:
-                        continue
-                    frequency[value] += a(Map.climates-i)
-
-            temperatures = list(range(Map.climates))
+        self.output_events(self.iter_soften_heatmap())
 
-            return random.choices(temperatures, frequency)[0]
+    def iter_soften_heatmap(self):
+        """ Softens the heatmap, yielding batches of the tiles collapsed """
 
         if not hasattr(self, 'heatmap'):
             raise Exception('Heatmap has not been generated')
 
-        random.seed(self.seed)
-        new_heatmap = Grid(self.height, self.width)
-
-        tiles = list()
-        for x in range(self.heatmap.width):
-            for y in range(self.heatmap.height):
-                value = self.heatmap[x][y].value
-                for x_off in range(self.resolution):
-                    for y_off in range(self.resolution):
-                        x_res_off = x*self.resolution + x_off
-                        y_res_off = y*self.resolution + y_off
-                        tile = new_heatmap[x_res_off][y_res_off]
-                        tile.value = value
-                        tiles.append(tile)
-                        tile.load_adjacent(Map.climates) # 5
-        random.shuffle(tiles)
-
-        while tiles:
-            tile = new_heatmap.find_next(tiles)
-            tile.collapse(pick_value(tile))
-            self.output.overlay_temperature(tile, self.landmass)
+        rng = self.rng.stream(self.seed, 'soften_heatmap')
+        new_heatmap = Grid(self.height, self.width, counters=self.counters)
+
+        # Scales up the heatmap, each tile covers a square of tiles the size of
+        # the resolution. Tiles keep the value of their square until they
+        # collapse, so the scaled up heatmap is never stored
+        upscaled = Upscaled(self.heatmap, self.resolution, self.height,
+                            self.width)
+
+        weights = soften_weights(Map.climates)
+        temperature = EventBatch('temperature')
+
+        if self.order == 'rounds':
+            # The tiles are softened a batch at a time on whole arrays
+            values = upscaled.grid.values.repeat(self.resolution, axis=0) \
+                .repeat(self.resolution, axis=1)[:self.width, :self.height]
+            values = values.copy()
+            batches = map_kernels.soften(values, map_random.generator(rng),
+                                         weights, Map.climates)
+            yield from Map.iter_collapsed(new_heatmap, values, batches,
+                                          temperature)
+        else:
+            # Lists the tiles in the order of the squares they fall in. An
+            # array shuffles exactly as a list would, with far less memory
+            # per tile
+            order = upscaled.order()
+            tiles = array.array('q' if order.dtype == np.int64 else 'i')
+            tiles.frombytes(order.tobytes())
+            del order
+            rng.shuffle(tiles)
+            tiles = new_heatmap.schedule(tiles)
+
+            counts = RingCounts(new_heatmap, Map.climates, weights,
+                                Map.climates, base=upscaled)
+            new_heatmap.observers.append(counts)
+
+            while tiles:
+                tile = new_heatmap.find_next(tiles)
+                tile.collapse(Map.pick_climate(tile, counts, rng,
+                                               self.counters))
+                if temperature.add(tile):
+                    yield temperature.take()
+
+            new_heatmap.observers.remove(counts)
+
+        if temperature:
+            yield temperature.take()
 
         self.resolution = 1
         self.heatmap = new_heatmap
         self.save_state()
 
+    @step
     def outline_landmass(self):
         """ Outlines the landmass """
 
+        self.output_events(self.iter_outline_landmass())
+
+    def iter_outline_landmass(self):
+        """ Outlines the landmass, yielding the positions of the coast """
+
+        self.outlined = True
+        if self.backend == 'numpy':
+            coast = map_kernels.outline_landmass(
+                self.landmass.values, Map.land, Map.water)
+            positions = [tuple(pos) for pos in np.argwhere(coast).tolist()]
+            yield Event('plot', positions, color=(255, 255, 255))
+            return
+
+        positions = list()
+
         for x in range(self.width):
             for y in range(self.height):
                 tile = self.landmass[x][y]
                 if tile.value == Map.water:
-                    tile.load_adjacent(1)
-                    for adjacent in tile.adjacent[0]:
+                    for adjacent in tile.get_tiles(1):
                         if adjacent.x != tile.x and adjacent.y != tile.y:
                             continue
                         if adjacent.value == Map.land:
-                            self.output.plot(tile.pos, (255, 255, 255))
+                            positions.append(tile.pos)
                             break
 
-    def generate_terrain(self):
+        yield Event('plot', positions, color=(255, 255, 255))
+
+    @step
+    def regenerate_region(self, x1, y1, x2, y2, seed=None, waterborder=4,
+                          control=10000):
+        """ Generates the tiles between the given positions again, leaving
+            every other tile as it is """
+
+        self.output_events(self.iter_regenerate_region(
+            x1, y1, x2, y2, seed, waterborder, control))
+
+    def iter_regenerate_region(self, x1, y1, x2, y2, seed=None,
+                               waterborder=4, control=10000):
+        """ Generates the tiles between the given positions again, yielding
+            batches of the tiles collapsed. The landmass inside the region is
+            collapsed again around the tiles outside of it, and so is a coarse
+            heatmap, while a softened heatmap is softened again. Only tiles
+            within as many layers of the region as are looked at are used, so
+            this takes time in proportion to the size of the region. Terrain
+            is the exception, it is quickly worked out again for the whole
+            map but only changed inside the region. The seed defaults to the
+            map's seed """
+
+        if not hasattr(self, 'landmass'):
+            raise Exception('Landmass has not been generated')
+
+        x1, y1 = max(x1, 0), max(y1, 0)
+        x2, y2 = min(x2, self.width), min(y2, self.height)
+        if x1 >= x2 or y1 >= y2:
+            raise Exception('Region is empty')
+
+        rng = self.rng.stream(self.seed if seed is None else seed,
+                              'regenerate_region')
+
+        # Tiles outside the water border stay as water
+        border = waterborder
+        lx1, ly1 = max(x1, border), max(y1, border)
+        lx2, ly2 = min(x2, self.width - border), min(y2, self.height - border)
+        if lx1 < lx2 and ly1 < ly2:
+            window, x, y = Map.region_window(
+                self.landmass, lx1, ly1, lx2, ly2, Map.layers)
+            tiles = Map.schedule_region(
+                window, lx1 - x, ly1 - y, lx2 - x, ly2 - y, rng)
+            relief = EventBatch('relief', window=(self.landmass, x, y))
+
+            # A region with no tiles beside it but the water border, such as
+            # the whole map, has nothing to grow from, so it is given land and
+            # water points as a new landmass is
+            inner = np.zeros(window.values.shape, dtype=bool)
+            inner[max(border - x, 0):self.width - border - x,
+                  max(border - y, 0):self.height - border - y] = True
+            inner[lx1-x:lx2-x, ly1-y:ly2-y] = False
+            beside = map_kernels.adjacent_to(inner)[lx1-x:lx2-x, ly1-y:ly2-y]
+            if not beside.any():
+                yield from Map.iter_place_points(
+                    window, lx1 - x, ly1 - y, lx2 - x - 1, ly2 - y - 1, rng,
+                    relief)
+
+            yield from Map.iter_collapse_land(window, tiles, control, rng,
+                                              relief, self.order == 'rounds')
+            if relief:
+                yield relief.take()
+
+        if hasattr(self, 'heatmap') and self.resolution > 1:
+            res = self.resolution
+            hx1, hy1 = x1 // res, y1 // res
+            hx2 = min(math.ceil(x2 / res), self.heatmap.width)
+            hy2 = min(math.ceil(y2 / res), self.heatmap.height)
+            window, x, y = Map.region_window(
+                self.heatmap, hx1, hy1, hx2, hy2, Map.climates)
+            tiles = Map.schedule_region(
+                window, hx1 - x, hy1 - y, hx2 - x, hy2 - y, rng)
+            domains = Domains(window, Map.climates, Map.climates)
+            window.observers.append(domains)
+            temperature = EventBatch('temperature', window=(self.heatmap, x, y),
+                                     resolution=res)
+            while tiles:
+                tile = window.find_next(tiles)
+                possibilities = domains.possibilities(tile.x, tile.y)
+                if self.counters is not None:
+                    self.counters['draws'] += 1
+                tile.collapse(rng.choice(possibilities))
+                if temperature.add(tile):
+                    yield temperature.take()
+            window.observers.remove(domains)
+            if temperature:
+                yield temperature.take()
+
+        elif hasattr(self, 'heatmap'):
+            # Tiles keep their softened value until they are softened again
+            window, x, y = Map.region_window(
+                self.heatmap, x1, y1, x2, y2, Map.climates, uncollapse=False)
+            tiles = Map.schedule_region(
+                window, x1 - x, y1 - y, x2 - x, y2 - y, rng)
+            weights = soften_weights(Map.climates)
+            counts = RingCounts(window, Map.climates, weights, Map.climates)
+            window.observers.append(counts)
+            temperature = EventBatch('temperature', window=(self.heatmap, x, y))
+            while tiles:
+                tile = window.find_next(tiles)
+                tile.collapse(Map.pick_climate(tile, counts, rng,
+                                               self.counters))
+                if temperature.add(tile):
+                    yield temperature.take()
+            window.observers.remove(counts)
+            if temperature:
+                yield temperature.take()
+
+        if hasattr(self, 'terrain'):
+            # The terrain is worked out as it was, but only changed inside
+            # the region
+            elevation, terrain = self.work_out_terrain(*self.terrain_options)
+            region = (slice(x1, x2), slice(y1, y2))
+            self.elevation.values[region] = elevation[region]
+            self.terrain.values[region] = terrain[region]
+            yield from self.iter_features(x1, y1, x2, y2)
+
+        if self.outlined:
+            # Tiles next to the region may have joined or left the coast, so
+            # they are drawn again before the coast is outlined
+            ox1, oy1 = max(x1 - 1, 0), max(y1 - 1, 0)
+            ox2, oy2 = min(x2 + 1, self.width), min(y2 + 1, self.height)
+            yield from self.iter_redraw(ox1, oy1, ox2, oy2)
+            wx1, wy1 = max(ox1 - 1, 0), max(oy1 - 1, 0)
+            wx2, wy2 = min(ox2 + 1, self.width), min(oy2 + 1, self.height)
+            coast = map_kernels.outline_landmass(
+                self.landmass.values[wx1:wx2, wy1:wy2], Map.land, Map.water)
+            coast = coast[ox1-wx1:ox2-wx1, oy1-wy1:oy2-wy1]
+            positions = [(x + ox1, y + oy1)
+                         for x, y in np.argwhere(coast).tolist()]
+            yield Event('plot', positions, color=(255, 255, 255))
+
+        self.save_state()
+
+    @staticmethod
+    def region_window(grid, x1, y1, x2, y2, layers, uncollapse=True):
+        """ Returns a window of the grid around a region, reaching as many
+            layers past it as a tile looks at, along with the position of the
+            window. The tiles in the region are uncollapsed unless asked not
+            to be """
+
+        x, y = max(x1 - layers, 0), max(y1 - layers, 0)
+        window = grid.window(x, y, min(x2 + layers, grid.width),
+                             min(y2 + layers, grid.height))
+        if uncollapse:
+            window.values[x1-x:x2-x, y1-y:y2-y] = -1
+        return window, x, y
+
+    @staticmethod
+    def schedule_region(window, x1, y1, x2, y2, rng):
+        """ Schedules the tiles of a region of a window in a shuffled order,
+            with the tiles next to those outside of the region flagged """
+
+        inside = np.zeros(window.values.shape, dtype=bool)
+        inside[x1:x2, y1:y2] = True
+        window.flags[:] = map_kernels.adjacent_to(~inside)
+        xs, ys = np.nonzero(inside)
+        tiles = (xs*window.height + ys).tolist()
+        rng.shuffle(tiles)
+        return window.schedule(tiles)
+
+    def iter_redraw(self, x1, y1, x2, y2):
+        """ Yields events to draw the tiles between the given positions """
+
+        relief = EventBatch('relief', size=None)
+        for x in range(x1, x2):
+            for y in range(y1, y2):
+                relief.add(self.landmass[x][y])
+        yield relief.take()
+
+        if hasattr(self, 'heatmap'):
+            res = self.resolution
+            temperature = EventBatch('temperature', size=None, resolution=res)
+            for x in range(x1 // res, math.ceil(x2 / res)):
+                for y in range(y1 // res, math.ceil(y2 / res)):
+                    temperature.add(self.heatmap[x][y])
+            yield temperature.take()
+
+        if hasattr(self, 'terrain'):
+            yield from self.iter_features(x1, y1, x2, y2)
+
+    @step
+    def generate_terrain(self, mountains=60, lakes=15, scale=16):
         """ Generates mountains and lakes on the landmass"""
 
-        pass
\ No newline at end of file
+        self.output_events(self.iter_generate_terrain(mountains, lakes, scale))
+
+    def iter_generate_terrain(self, mountains=60, lakes=15, scale=16):
+        """ Generates mountains and lakes on the landmass, yielding batches of
+            the tiles which became mountains or lakes. The elevation of land
+            rises with its distance from the coast and with seeded noise, from
+            0 to 100, and land at or above the mountain elevation becomes one
+            of three heights of mountain. Land at least three tiles from the
+            coast where the noise is below the lakes percentage becomes lake """
+
+        if not hasattr(self, 'landmass'):
+            raise Exception('Landmass has not been generated')
+
+        self.terrain_options = (self.seed, mountains, lakes, scale)
+        elevation, terrain = self.work_out_terrain(*self.terrain_options)
+        self.elevation = Grid(self.height, self.width, elevation,
+                              counters=self.counters)
+        self.terrain = Grid(self.height, self.width, terrain,
+                            counters=self.counters)
+
+        yield from self.iter_features(0, 0, self.width, self.height)
+        self.save_state()
+
+    def work_out_terrain(self, seed, mountains, lakes, scale):
+        """ Returns the elevation and terrain of the landmass. The terrain is
+            the landmass with lakes and mountains, as indices of the reliefs
+            in map_output.Colors """
+
+        rng = self.rng.stream(seed, 'generate_terrain')
+
+        # Three octaves of noise, each with half the spacing and half the
+        # weight of the last, stretched to cover 0 to 1
+        noise = np.zeros((self.width, self.height))
+        for octave in range(3):
+            spacing = max(scale >> octave, 1)
+            shape = (self.width // spacing + 2, self.height // spacing + 2)
+            draws = [rng.random() for _ in range(shape[0]*shape[1])]
+            lattice = np.array(draws).reshape(shape)
+            noise += map_kernels.value_noise(lattice, spacing, noise.shape) \
+                / 2**octave
+        noise -= noise.min()
+        noise /= max(noise.max(), 1e-9)
+
+        land = self.landmass.values == Map.land
+        distance = map_kernels.distance_to(~land)
+        inland = distance / max(int(distance[land].max(initial=1)), 1)
+        height = np.where(land, 0.6*inland + 0.4*noise, 0)
+        elevation = np.round(height*100).astype(np.int8)
+
+        terrain = self.landmass.values.copy()
+        is_lake = land & (distance >= 3) & (noise*100 < lakes)
+        terrain[is_lake] = Map.lake
+        step = max((100 - mountains) // 3, 1)
+        level = np.minimum((elevation.astype(np.int16) - mountains) // step, 2)
+        is_mountain = land & ~is_lake & (elevation >= mountains)
+        terrain[is_mountain] = Map.mountain + level[is_mountain]
+        return elevation, terrain
+
+    def iter_features(self, x1, y1, x2, y2):
+        """ Yields events to draw the mountains and lakes between the given
+            positions """
+
+        relief = EventBatch('relief')
+        features = self.terrain.values[x1:x2, y1:y2] >= Map.lake
+        for x, y in np.argwhere(features).tolist():
+            if relief.add(self.terrain[x + x1][y + y1]):
+                yield relief.take()
+        if relief:
+            yield relief.take()
\ No newline at end of file
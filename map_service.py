@@ -0,0 +1,487 @@
+import map_batch
+import map_cache
+import numpy as np
+import concurrent.futures
+import multiprocessing
+import collections
+import urllib.parse
+import functools
+import argparse
+import asyncio
+import threading
+import hashlib
+import queue
+import random
+import json
+import io
+import os
+
+
+# The steps a job can ask for
+steps = tuple(name for name, _ in map_batch.pipeline)
+
+# The largest pixel size a job can ask for, and the most pixels its image
+# can have, so that no single job can take up all of a worker's memory
+max_pixel_size = 16
+max_pixels = 2**24
+
+formats = {
+    'png': 'image/png',
+    'ppm': 'image/x-portable-pixmap',
+    'npz': 'application/octet-stream',
+}
+
+reasons = {
+    200: 'OK', 202: 'Accepted', 400: 'Bad Request', 404: 'Not Found',
+    405: 'Method Not Allowed', 500: 'Internal Server Error',
+    503: 'Service Unavailable', 504: 'Gateway Timeout',
+}
+
+
+class RequestError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def is_integer(value):
+    """ Returns whether a JSON value is an integer, JSON's true and false
+        are not """
+
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def parse_job(spec, max_size):
+    """ Returns the job described by a request, with every field checked and
+        filled in, raising a RequestError if it is not a valid job """
+
+    if not isinstance(spec, dict):
+        raise RequestError(400, 'A job must be a JSON object')
+    if 'height' not in spec or 'width' not in spec:
+        raise RequestError(400, 'A job needs a height and width')
+    height = spec['height']
+    width = spec['width']
+    if (not is_integer(height) or not is_integer(width)
+            or not (0 < height <= max_size and 0 < width <= max_size)):
+        raise RequestError(
+            400, f'Dimensions must be integers from 1 to {max_size}')
+
+    seed = spec.get('seed')
+    if seed is None:
+        seed = random.randint(0, 2**32-1)
+    if not is_integer(seed) or not 0 <= seed < 2**32:
+        raise RequestError(400, 'The seed must be a 32 bit integer')
+
+    job_steps = list()
+    for step in spec.get('steps', map_batch.pipeline):
+        if isinstance(step, str):
+            step = (step, {})
+        if (not isinstance(step, (list, tuple)) or len(step) != 2
+                or step[0] not in steps or not isinstance(step[1], dict)):
+            raise RequestError(400, f'Unknown step {step!r}')
+        job_steps.append((step[0], step[1]))
+    try:
+        map_cache.describe_steps(job_steps)
+    except TypeError as error:
+        raise RequestError(400, str(error))
+
+    format = spec.get('format', 'png')
+    if format not in formats:
+        raise RequestError(400, f'Unknown format {format!r}')
+
+    pixel_size = spec.get('pixel_size', 1)
+    if not is_integer(pixel_size) or not 0 < pixel_size <= max_pixel_size:
+        raise RequestError(
+            400, f'The pixel size must be an integer from 1 to '
+                 f'{max_pixel_size}')
+    if width*height*pixel_size**2 > max_pixels:
+        raise RequestError(400, f'Images can have at most {max_pixels} '
+                                f'pixels')
+
+    return {'height': height, 'width': width, 'seed': seed,
+            'steps': job_steps, 'format': format, 'pixel_size': pixel_size}
+
+
+def job_id(job):
+    """ Returns the id of a job, which is the same for identical jobs """
+
+    data = json.dumps(job, sort_keys=True).encode()
+    return hashlib.sha256(data).hexdigest()[:16]
+
+
+def report(progress, id, step, tiles):
+    progress.put((id, step, tiles))
+
+
+# The cache of each worker process, on disk so that it is shared. Worker
+# threads share one cache, which is created by the first of them
+worker_cache = None
+worker_lock = threading.Lock()
+
+
+def work(id, job, progress, directory=None):
+    """ Generates the map of a job in a worker process or thread, returning
+        it encoded in the job's format """
+
+    global worker_cache
+    with worker_lock:
+        if directory is not None and worker_cache is None:
+            worker_cache = map_cache.Cache(size=16, directory=directory)
+
+    image = job['format'] if job['format'] != 'npz' else None
+    result = map_batch.generate(
+        job['height'], job['width'], job['seed'], job['steps'], image,
+        job['pixel_size'], worker_cache,
+        functools.partial(report, progress, id))
+    if image is not None:
+        return result['image']
+
+    file = io.BytesIO()
+    arrays = {k: v for k, v in result.items() if isinstance(v, np.ndarray)}
+    np.savez_compressed(file, **arrays)
+    return file.getvalue()
+
+
+def idle():
+    pass
+
+
+class Job:
+
+    def __init__(self, id, spec):
+        """ A map being generated for one or more requests. Events describing
+            its progress are kept so that every listener sees all of them """
+
+        self.id = id
+        self.spec = spec
+        self.status = 'queued'
+        self.events = list()
+        self.result = None
+        self.error = None
+        # The tiles collapsed so far by the current step
+        self.tiles = 0
+
+        # Replaced by a new event each time an event is posted
+        self.changed = asyncio.Event()
+        self.done = asyncio.Event()
+
+    def describe(self):
+        info = {'id': self.id, 'status': self.status,
+                'seed': self.spec['seed'], 'format': self.spec['format']}
+        if self.error is not None:
+            info['error'] = self.error
+        return info
+
+    def post(self, event):
+        self.events.append(event)
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def finish(self, status, result=None, error=None):
+        self.status = status
+        self.result = result
+        self.error = error
+        event = {'event': status}
+        if error is not None:
+            event['error'] = error
+        self.post(event)
+        self.done.set()
+
+    async def listen(self):
+        """ Yields every event of the job, from the first, until it is done """
+
+        index = 0
+        while True:
+            while index == len(self.events):
+                await self.changed.wait()
+            event = self.events[index]
+            index += 1
+            yield event
+            if event['event'] in ('done', 'failed', 'timeout'):
+                return
+
+
+class Service:
+
+    def __init__(self, workers=None, max_jobs=32, timeout=60.0, retain=64,
+                 max_size=2048, cache=None, threads=False):
+        """ Generates maps on a pool of worker processes, or of threads in
+            this process if asked. At most max_jobs jobs can be waiting or
+            running at once, each of which fails if it has not finished
+            timeout seconds after it was submitted. The latest finished jobs
+            are kept so that repeated requests are answered straight away.
+            Cache is a directory the workers share for map_cache """
+
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self.timeout = timeout
+        self.retain = retain
+        self.max_size = max_size
+        self.cache = cache
+        self.threads = threads
+
+        self.jobs = dict()
+        self.finished = collections.OrderedDict()
+        # Jobs whose worker is still busy, including those that timed out
+        self.active = 0
+
+    async def start(self):
+        if self.threads:
+            # Each map has its own state, so maps can be generated at once
+            self.executor = concurrent.futures.ThreadPoolExecutor(self.workers)
+            self.manager = None
+            self.progress = queue.Queue()
+        else:
+            workers = self.workers or os.cpu_count() or 1
+            self.executor = concurrent.futures.ProcessPoolExecutor(workers)
+            self.manager = multiprocessing.Manager()
+            self.progress = self.manager.Queue()
+            # Workers are forked as they are first needed, which would give
+            # them a copy of every connection open at the time and keep the
+            # connections from closing, so they are all started now, before
+            # the service takes any connections
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(*(loop.run_in_executor(self.executor, idle)
+                                   for _ in range(workers)))
+        # Progress is read on a thread of its own, as reading blocks
+        self.listener = threading.Thread(
+            target=self.listen, args=(asyncio.get_running_loop(),),
+            daemon=True)
+        self.listener.start()
+
+    async def stop(self):
+        try:
+            self.progress.put(None)
+        except (EOFError, OSError):
+            pass
+        # The listener passes progress on to the loop, which must still be
+        # running, so it is left to finish first
+        self.listener.join()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        if self.manager is not None:
+            self.manager.shutdown()
+
+    def submit(self, spec):
+        """ Returns the job for a request, starting it unless an identical job
+            is already running or has recently finished """
+
+        job = parse_job(spec, self.max_size)
+        id = job_id(job)
+        if id in self.jobs:
+            return self.jobs[id]
+        if id in self.finished:
+            self.finished.move_to_end(id)
+            return self.finished[id]
+
+        if self.active >= self.max_jobs:
+            raise RequestError(503, 'Too many jobs, try again later')
+
+        job = Job(id, job)
+        self.jobs[id] = job
+        self.active += 1
+        asyncio.create_task(self.run(job))
+        return job
+
+    def get(self, id):
+        job = self.jobs.get(id) or self.finished.get(id)
+        if job is None:
+            raise RequestError(404, f'No job {id!r}')
+        return job
+
+    async def run(self, job):
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.executor, work, job.id, job.spec,
+                                      self.progress, self.cache)
+        # A worker can not be stopped part way through a map, so a job which
+        # times out still counts towards the limit until its worker is free
+        future.add_done_callback(self.release)
+        try:
+            result = await asyncio.wait_for(asyncio.shield(future),
+                                            self.timeout)
+        except asyncio.TimeoutError:
+            job.finish('timeout', error='The job took too long')
+        except Exception as error:
+            job.finish('failed', error=repr(error))
+        else:
+            job.finish('done', result)
+
+        del self.jobs[job.id]
+        self.finished[job.id] = job
+        while len(self.finished) > self.retain:
+            self.finished.popitem(last=False)
+
+    def release(self, future):
+        self.active -= 1
+
+    def listen(self, loop):
+        """ Passes on the progress reported by the workers to the loop """
+
+        while True:
+            try:
+                item = self.progress.get()
+            except (EOFError, OSError):
+                return
+            if item is None:
+                return
+            loop.call_soon_threadsafe(self.update, *item)
+
+    def update(self, id, step, tiles):
+        """ Posts the progress of a worker to its job """
+
+        job = self.jobs.get(id)
+        if job is None:
+            return
+        job.status = 'running'
+        if tiles == 0:
+            job.tiles = 0
+            job.post({'event': 'step', 'step': step})
+        else:
+            job.tiles += tiles
+            job.post({'event': 'progress', 'step': step, 'tiles': job.tiles})
+
+    async def handle(self, reader, writer):
+        """ Answers a single HTTP request """
+
+        try:
+            method, path, body = await read_request(reader)
+            await self.route(method, path, body, writer)
+        except RequestError as error:
+            await respond(writer, error.status, {'error': str(error)})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as error:
+            # Anything unexpected is still answered, so the client is not
+            # left waiting
+            try:
+                await respond(writer, 500, {'error': repr(error)})
+            except ConnectionError:
+                pass
+        finally:
+            writer.close()
+
+    async def route(self, method, path, body, writer):
+        url = urllib.parse.urlsplit(path)
+        parts = [part for part in url.path.split('/') if part]
+
+        if parts == ['jobs'] and method == 'POST':
+            try:
+                spec = json.loads(body or b'{}')
+            except ValueError:
+                raise RequestError(400, 'The job is not valid JSON')
+            job = self.submit(spec)
+            await respond(writer, 202, job.describe())
+        elif parts == ['status'] and method == 'GET':
+            await respond(writer, 200, {'active': self.active,
+                                        'max_jobs': self.max_jobs})
+        elif len(parts) >= 2 and parts[0] == 'jobs' and method == 'GET':
+            job = self.get(parts[1])
+            if len(parts) == 2:
+                await respond(writer, 200, job.describe())
+            elif parts[2:] == ['events']:
+                await stream(writer, job.listen())
+            elif parts[2:] == ['result']:
+                await job.done.wait()
+                if job.status == 'done':
+                    await respond(writer, 200, job.result,
+                                  formats[job.spec['format']])
+                else:
+                    status = 504 if job.status == 'timeout' else 500
+                    await respond(writer, status, job.describe())
+            else:
+                raise RequestError(404, f'Unknown path {url.path!r}')
+        elif parts and parts[0] in ('jobs', 'status'):
+            raise RequestError(405, f'{method} is not allowed')
+        else:
+            raise RequestError(404, f'Unknown path {url.path!r}')
+
+
+async def read_request(reader):
+    """ Returns the method, path and body of an HTTP request """
+
+    line = await reader.readline()
+    try:
+        method, path, _ = line.decode('latin-1').split()
+    except ValueError:
+        raise RequestError(400, 'Malformed request')
+
+    headers = dict()
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    length = int(headers.get('content-length', 0) or 0)
+    if length > 2**16:
+        raise RequestError(400, 'The request is too large')
+    body = await reader.readexactly(length) if length else b''
+    return method, path, body
+
+
+def head(status, content_type, length=None):
+    lines = [f'HTTP/1.1 {status} {reasons[status]}',
+             f'Content-Type: {content_type}', 'Connection: close']
+    if length is not None:
+        lines.append(f'Content-Length: {length}')
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+async def respond(writer, status, body, content_type='application/json'):
+    if not isinstance(body, bytes):
+        body = json.dumps(body).encode()
+    writer.write(head(status, content_type, len(body)) + body)
+    await writer.drain()
+
+
+async def stream(writer, events):
+    """ Sends events as lines of JSON as they happen, the response ends when
+        the connection is closed """
+
+    writer.write(head(200, 'application/x-ndjson'))
+    async for event in events:
+        writer.write(json.dumps(event).encode() + b'\n')
+        await writer.drain()
+
+
+async def serve(host='127.0.0.1', port=8000, **options):
+    service = Service(**options)
+    await service.start()
+    server = await asyncio.start_server(service.handle, host, port)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.stop()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Serves map generation over HTTP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of processes, defaults to the CPU count')
+    parser.add_argument('--threads', action='store_true',
+                        help='generate on threads of this process instead')
+    parser.add_argument('--max-jobs', type=int, default=32,
+                        help='jobs which can be waiting or running at once')
+    parser.add_argument('--timeout', type=float, default=60.0,
+                        help='seconds a job has to finish once submitted')
+    parser.add_argument('--max-size', type=int, default=2048)
+    parser.add_argument('--cache', default=None,
+                        help='a directory for the workers to cache states in')
+    args = parser.parse_args(args)
+
+    try:
+        asyncio.run(serve(args.host, args.port, workers=args.workers,
+                          max_jobs=args.max_jobs, timeout=args.timeout,
+                          max_size=args.max_size, cache=args.cache,
+                          threads=args.threads))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+from map_rewrite import Map
+import map_batch
+import map_cache
+import numpy as np
+
+
+steps = map_batch.pipeline
+
+
+def generate(cache, seed=4, **kwargs):
+    """ Generates a map through the cache, returning it and the steps run """
+
+    run = list()
+    map = Map(40, 48, seed, **kwargs)
+    map_cache.generate(map, steps, cache,
+                       lambda name, tiles: tiles or run.append(name))
+    return map, run
+
+
+def assert_same(map, expected):
+    for name in ('landmass', 'heatmap', 'elevation', 'terrain'):
+        assert np.array_equal(getattr(map, name).values,
+                              getattr(expected, name).values)
+    assert map.seed == expected.seed
+
+
+def test_cached_steps_are_not_run_again():
+    cache = map_cache.Cache()
+    expected, run = generate(cache)
+    assert run == [name for name, _ in steps]
+
+    map, run = generate(cache)
+    # Outlining saves no state, so it is always run
+    assert run == ['outline_landmass']
+    assert_same(map, expected)
+
+
+def test_entries_round_trip_through_disk(tmp_path):
+    expected, _ = generate(map_cache.Cache(directory=tmp_path))
+    assert len(list(tmp_path.glob('*.npz'))) == len(steps) - 1
+
+    map, run = generate(map_cache.Cache(directory=tmp_path))
+    assert run == ['outline_landmass']
+    assert_same(map, expected)
+
+
+def test_generation_resumes_from_the_last_step_cached(tmp_path):
+    cache = map_cache.Cache(size=1, directory=tmp_path)
+    map = Map(40, 48, 4)
+    map_cache.generate(map, steps[:3], cache)
+    cache.clear()
+
+    map, run = generate(cache)
+    assert run == [name for name, _ in steps[3:]]
+    assert_same(map, generate(map_cache.Cache())[0])
+
+
+def test_keys_cover_what_changes_the_map():
+    map = Map(40, 48, 4)
+    key = map_cache.key(map, steps)
+    assert key == map_cache.key(Map(40, 48, 4), [
+        (name, dict(kwargs)) for name, kwargs in steps])
+    assert key != map_cache.key(Map(40, 48, 5), steps)
+    assert key != map_cache.key(Map(48, 40, 4), steps)
+    assert key != map_cache.key(Map(40, 48, 4, rng='streams'), steps)
+    assert key != map_cache.key(Map(40, 48, 4, order='rounds'), steps)
+    assert key != map_cache.key(map, steps[:-1])
+    # Arguments equal to the defaults are described as the defaults are
+    assert (map_cache.key(map, [('generate_landmass', {})])
+            == map_cache.key(map, [('generate_landmass',
+                                    {'waterborder': 4})]))
+    assert (map_cache.key(map, [('generate_landmass', {})])
+            != map_cache.key(map, [('generate_landmass',
+                                    {'waterborder': 2})]))
+
+
+def test_random_state_round_trips():
+    cache = map_cache.Cache()
+    map, _ = generate(cache)
+    entry = map_cache.Entry.take(map)
+    loaded = map_cache.Entry.from_arrays(entry.arrays())
+    assert loaded.random_state == entry.random_state
+    assert (loaded.seed, loaded.next_seed) == (entry.seed, entry.next_seed)
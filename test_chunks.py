@@ -0,0 +1,54 @@
+from map_chunks import World
+from map_rewrite import Map
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize('rng', ('legacy', 'streams'))
+def test_chunks_match_in_any_order(rng):
+    whole = World(seed=7, chunk_size=24, rng=rng)
+    expected = whole.region(0, 0, 72, 72)
+
+    parts = World(seed=7, chunk_size=24, rng=rng)
+    for i, j in ((2, 1), (0, 2), (1, 1), (2, 0)):
+        parts.chunk(i, j)
+    assert np.array_equal(parts.region(0, 0, 72, 72), expected)
+    # Regions which do not line up with the chunks are cut from the same
+    # landmass
+    assert np.array_equal(parts.region(-10, 13, 50, 40),
+                          np.concatenate((parts.region(-10, 13, 20, 40),
+                                          parts.region(20, 13, 50, 40))))
+    assert np.array_equal(parts.region(5, 30, 60, 70), expected[5:60, 30:70])
+
+
+def test_chunks_are_kept_on_disk(tmp_path):
+    world = World(seed=7, chunk_size=24, directory=tmp_path)
+    expected = world.region(-24, 0, 48, 48)
+    assert len(list(tmp_path.iterdir())) == 6
+
+    loaded = World(seed=7, chunk_size=24, directory=tmp_path)
+    assert np.array_equal(loaded.region(-24, 0, 48, 48), expected)
+    assert np.array_equal(World(seed=7, chunk_size=24).region(-24, 0, 48, 48),
+                          expected)
+
+
+def test_land_and_water_meet_at_chunk_borders():
+    world = World(seed=3, chunk_size=32)
+    values = world.region(0, 0, 96, 96)
+    assert ((values == Map.land) | (values == Map.water)).all()
+    assert (values == Map.land).any() and (values == Map.water).any()
+
+
+def test_map_of_a_region():
+    world = World(seed=3, chunk_size=32)
+    map = world.map(10, 20, 70, 60)
+    assert (map.width, map.height) == (60, 40)
+    assert np.array_equal(map.landmass.values, world.region(10, 20, 70, 60))
+    map.generate_heatmap()
+    map.soften_heatmap()
+    assert map.heatmap.values.shape == (60, 40)
+
+
+def test_chunks_must_be_larger_than_their_border():
+    with pytest.raises(Exception):
+        World(chunk_size=2*Map.layers)
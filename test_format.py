@@ -0,0 +1,61 @@
+from map_rewrite import Map
+import map_format
+import numpy as np
+import pytest
+
+
+def test_landmass_and_heatmap_round_trip(tmp_path):
+    path = tmp_path / 'map.bin'
+    map = Map(40, 48, seed=9)
+    map.generate_landmass()
+    map.generate_heatmap()
+    map.save(path)
+
+    loaded = Map.load(path)
+    assert (loaded.width, loaded.height, loaded.seed) == (48, 40, map.seed)
+    assert np.array_equal(loaded.landmass.values, map.landmass.values)
+    assert np.array_equal(loaded.heatmap.values, map.heatmap.values)
+    assert loaded.resolution == map.resolution
+    assert map_format.read_header(path).step == 2
+
+
+def test_loaded_map_carries_on_as_the_map_saved(tmp_path):
+    path = tmp_path / 'map.bin'
+    map = Map(40, 48, seed=9)
+    map.generate_landmass()
+    map.generate_heatmap()
+    map.save(path)
+    loaded = Map.load(path)
+
+    map.soften_heatmap()
+    loaded.soften_heatmap()
+    assert np.array_equal(loaded.heatmap.values, map.heatmap.values)
+
+
+def test_changes_are_not_written_back(tmp_path):
+    path = tmp_path / 'map.bin'
+    map = Map(30, 30, seed=9)
+    map.generate_landmass()
+    map.save(path)
+
+    loaded = Map.load(path)
+    loaded.landmass.values[:] = Map.water
+    assert np.array_equal(Map.load(path).landmass.values,
+                          map.landmass.values)
+
+
+def test_landmass_only(tmp_path):
+    path = tmp_path / 'map.bin'
+    map = Map(30, 20, seed=9)
+    map.generate_landmass()
+    map.save(path)
+    loaded = Map.load(path)
+    assert np.array_equal(loaded.landmass.values, map.landmass.values)
+    assert not hasattr(loaded, 'heatmap')
+
+
+def test_other_files_are_refused(tmp_path):
+    path = tmp_path / 'map.bin'
+    path.write_bytes(b'\0' * map_format.header_size)
+    with pytest.raises(Exception):
+        Map.load(path)
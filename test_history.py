@@ -0,0 +1,78 @@
+from map_rewrite import Map
+import numpy as np
+
+
+steps = (
+    ('generate_landmass', {}),
+    ('remove_lone_tiles', {'threshold': 1}),
+    ('centre_landmass', {}),
+    ('generate_heatmap', {}),
+    ('soften_heatmap', {}),
+)
+
+
+def generate(map):
+    """ Runs the steps, returning the grids and seed after each """
+
+    saved = list()
+    for name, kwargs in steps:
+        getattr(map, name)(**kwargs)
+        heatmap = None
+        if hasattr(map, 'heatmap'):
+            heatmap = map.heatmap.values.copy()
+        saved.append((map.landmass.values.copy(), heatmap, map.seed))
+    return saved
+
+
+def assert_state(map, saved):
+    landmass, heatmap, seed = saved
+    assert np.array_equal(map.landmass.values, landmass)
+    if heatmap is None:
+        assert not hasattr(map, 'heatmap')
+    else:
+        assert np.array_equal(map.heatmap.values, heatmap)
+    assert map.seed == seed
+
+
+def test_every_state_is_rebuilt():
+    map = Map(40, 48, seed=2)
+    saved = generate(map)
+    assert len(map.states) == len(steps)
+    for index, (landmass, heatmap, _) in enumerate(saved):
+        state = map.states.state(index)
+        assert np.array_equal(state['landmass'], landmass)
+        if heatmap is not None:
+            assert np.array_equal(state['heatmap'], heatmap)
+
+
+def test_restore_undoes_steps():
+    map = Map(40, 48, seed=2)
+    saved = generate(map)
+
+    map.restore_state()
+    assert len(map.states) == len(steps) - 1
+    assert_state(map, saved[-2])
+    # The step taken again gives the same map
+    map.soften_heatmap()
+    assert_state(map, saved[-1])
+
+    map.restore_state(1)
+    assert len(map.states) == 1
+    assert_state(map, saved[0])
+
+    map.restore_state(0)
+    assert len(map.states) == 0
+    assert not hasattr(map, 'landmass')
+    assert map.seed == 2
+
+
+def test_max_states_keeps_the_latest():
+    map = Map(40, 48, seed=2, max_states=2)
+    saved = generate(map)
+    assert len(map.states) == 2
+    assert len(map.states.patches) == 2
+
+    map.restore_state()
+    assert_state(map, saved[-2])
+    map.soften_heatmap()
+    assert_state(map, saved[-1])
@@ -0,0 +1,53 @@
+from map_rewrite import Map
+from map_profile import Instruments
+import pytest
+
+
+def counters(instruments):
+    return {record['step']: record['counters']
+            for record in instruments.records}
+
+
+@pytest.mark.parametrize('backend', Map.backends)
+def test_steps_count_into_their_own_record(backend):
+    instruments = Instruments()
+    map = Map(40, 48, seed=1, backend=backend, instruments=instruments)
+    map.generate_landmass()
+    landmass = dict(counters(instruments)['generate_landmass'])
+    map.remove_lone_tiles(threshold=1)
+    map.regenerate_region(5, 5, 20, 20)
+    map.generate_heatmap()
+    map.soften_heatmap()
+
+    # Later steps collapsing tiles of the landmass leave its record alone
+    steps = counters(instruments)
+    assert steps['generate_landmass'] == landmass
+    assert steps['remove_lone_tiles']['collapsed'] > 0
+    for name in ('regenerate_region', 'soften_heatmap'):
+        assert steps[name]['collapsed'] > 0
+        assert steps[name]['draws'] > 0
+        assert steps[name]['frontier'] + steps[name].get('fallback', 0) > 0
+    assert map.counters is None
+    assert map.landmass.counters is None
+
+
+def test_steps_count_the_same_on_both_backends():
+    records = list()
+    for backend in Map.backends:
+        instruments = Instruments()
+        map = Map(40, 48, seed=1, backend=backend, instruments=instruments)
+        map.generate_landmass()
+        map.remove_lone_tiles(threshold=1)
+        map.regenerate_region(5, 5, 20, 20)
+        records.append(counters(instruments))
+    assert records[0] == records[1]
+
+
+def test_run_step_with_progress_is_measured():
+    instruments = Instruments()
+    map = Map(40, 48, seed=1, instruments=instruments)
+    seen = list()
+    map.run_step('generate_landmass', {}, lambda name, count:
+                 seen.append(name))
+    assert seen[0] == 'generate_landmass'
+    assert counters(instruments)['generate_landmass']['collapsed'] > 0
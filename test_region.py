@@ -0,0 +1,31 @@
+from map_rewrite import Map
+import numpy as np
+
+
+def test_whole_map_without_border():
+    map = Map(30, 30, seed=1)
+    map.generate_landmass(waterborder=0)
+    map.regenerate_region(0, 0, 30, 30, waterborder=0)
+    assert (map.landmass.values >= 0).all()
+
+
+def test_whole_map_grows_land():
+    for seed in range(3):
+        map = Map(60, 60, seed=seed)
+        map.generate_landmass()
+        map.regenerate_region(0, 0, 60, 60)
+        values = map.landmass.values
+        assert (values == Map.land).any()
+        assert (values[:4] == Map.water).all()
+        assert (values[:, -4:] == Map.water).all()
+
+
+def test_tiles_outside_region_are_kept():
+    map = Map(50, 40, seed=5)
+    map.generate_landmass()
+    before = map.landmass.values.copy()
+    map.regenerate_region(10, 10, 30, 25, seed=2)
+    inside = np.zeros(before.shape, dtype=bool)
+    inside[10:30, 10:25] = True
+    assert np.array_equal(before[~inside], map.landmass.values[~inside])
+    assert (map.landmass.values >= 0).all()
@@ -0,0 +1,62 @@
+from map_rewrite import Map, land_weights
+import map_kernels
+import map_chunks
+import numpy as np
+import pytest
+
+
+def test_rounds_collapse_tiles_apart():
+    weights, total = land_weights(Map.layers)
+    values = np.full((40, 30), -1)
+    values[:, :2] = Map.water
+    values[20, 15] = Map.land
+    pending = values == -1
+    generator = np.random.default_rng(1)
+
+    rounds = map_kernels.collapse_land(values, pending, generator, 10000,
+                                       weights, total, Map.land, Map.water)
+    collapsed = 0
+    for xs, ys in rounds:
+        collapsed += len(xs)
+        # No two tiles of a round are close enough to count each other
+        apart = np.maximum(abs(xs[:, None] - xs), abs(ys[:, None] - ys))
+        np.fill_diagonal(apart, len(weights) + 1)
+        assert (apart > len(weights)).all()
+    assert collapsed == pending.sum()
+    assert (values >= 0).all()
+
+
+@pytest.mark.parametrize('rng', ('legacy', 'streams'))
+def test_rounds_give_the_same_map_for_a_seed(rng):
+    maps = [Map(60, 50, seed=3, rng=rng, order='rounds') for _ in range(2)]
+    for map in maps:
+        map.generate_landmass()
+        map.generate_heatmap()
+        map.soften_heatmap()
+        map.regenerate_region(10, 10, 30, 30)
+    assert np.array_equal(maps[0].landmass.values, maps[1].landmass.values)
+    assert np.array_equal(maps[0].heatmap.values, maps[1].heatmap.values)
+    assert (maps[0].landmass.values == Map.land).any()
+
+
+def test_rng_alone_keeps_collapsing_tile_by_tile():
+    tiles = Map(40, 40, seed=3, rng='streams')
+    rounds = Map(40, 40, seed=3, rng='streams', order='rounds')
+    tiles.generate_landmass()
+    rounds.generate_landmass()
+    assert tiles.order == 'tiles'
+    assert not np.array_equal(tiles.landmass.values, rounds.landmass.values)
+
+
+def test_chunks_in_rounds_match_in_any_order():
+    whole = map_chunks.World(seed=4, chunk_size=24, order='rounds')
+    parts = map_chunks.World(seed=4, chunk_size=24, order='rounds')
+    parts.region(40, 40, 72, 72)
+    parts.region(0, 20, 30, 72)
+    assert np.array_equal(whole.region(0, 0, 72, 72),
+                          parts.region(0, 0, 72, 72))
+
+
+def test_unknown_order():
+    with pytest.raises(Exception):
+        Map(10, 10, order='diagonal')
@@ -0,0 +1,84 @@
+from map_rewrite import Map
+import map_batch
+import map_cache
+import numpy as np
+import hashlib
+import pytest
+
+
+# The landmass, softened heatmap and outline of maps made before the frontier
+# scheduler, so any change to the order tiles collapse in shows up here
+hashes = {
+    (40, 48, 1): ('d66ebffb335ee26422a5b239d4b285d2',
+                  'b550e6abc97f406f92bb163117dd3dad',
+                  'b3bb77fc6022d8af03b43cd627563d20'),
+    (48, 48, 586920373): ('872eaa2c855b8df3f69025e8318984f6',
+                          '5a0f5c41a50066e1b9f2679f13e18614',
+                          '1c8ddb8603e5985b059d07f82766bc90'),
+    (32, 64, 7): ('a225e9dad9c30abe487d1eb70c8282a8',
+                  'a4fc4537ee6a5deb338f66d1acfabdc0',
+                  '800e78aa47d3cdd68de7ba16316a4c54'),
+}
+
+
+def digest(values):
+    data = np.asarray(values, dtype=np.int64).tobytes()
+    return hashlib.md5(data).hexdigest()
+
+
+@pytest.mark.parametrize('backend', Map.backends)
+@pytest.mark.parametrize('case', hashes)
+def test_seed_gives_same_map(case, backend):
+    height, width, seed = case
+    map = Map(height, width, seed=seed, backend=backend)
+    map.generate_landmass()
+    map.remove_lone_tiles(threshold=1)
+    map.centre_landmass()
+    map.generate_heatmap()
+    map.soften_heatmap()
+    outline = list()
+    for event in map.iter_outline_landmass():
+        outline.extend(tuple(pos) for pos in event.positions)
+    outline = hashlib.md5(repr(sorted(outline)).encode()).hexdigest()
+
+    landmass, heatmap, coast = hashes[case]
+    assert digest(map.landmass.values) == landmass
+    assert digest(map.heatmap.values) == heatmap
+    assert outline == coast
+
+
+def assert_same(result, expected):
+    assert result.keys() == expected.keys()
+    for name, value in expected.items():
+        assert np.array_equal(result[name], value)
+
+
+@pytest.mark.parametrize('workers, threads, cached', [
+    (1, False, None), (2, True, None), (2, False, None),
+    (2, True, 'memory'), (2, False, 'memory'), (2, False, 'disk'),
+])
+def test_generate_many_matches_serial(workers, threads, cached, tmp_path):
+    seeds = [1, 7, 586920373]
+    expected = [map_batch.generate(40, 48, seed) for seed in seeds]
+    cache = None
+    if cached is not None:
+        directory = tmp_path if cached == 'disk' else None
+        cache = map_cache.Cache(size=16, directory=directory)
+    # Generated twice so the second run starts from the cache
+    for _ in range(2 if cache is not None else 1):
+        results = map_batch.generate_many(40, 48, seeds, workers=workers,
+                                          threads=threads, cache=cache)
+        for result, serial in zip(results, expected):
+            assert_same(result, serial)
+
+
+def test_cached_generate_matches_serial():
+    cache = map_cache.Cache(size=16)
+    for seed in [1, 7]:
+        expected = map_batch.generate(40, 48, seed)
+        for _ in range(2):
+            map = Map(40, 48, seed)
+            map_cache.generate(map, map_batch.pipeline, cache)
+            assert digest(map.landmass.values) == digest(expected['landmass'])
+            assert digest(map.heatmap.values) == digest(expected['heatmap'])
+            assert digest(map.terrain.values) == digest(expected['terrain'])
@@ -0,0 +1,57 @@
+from map_service import RequestError, Service, parse_job
+import map_batch
+import asyncio
+import pytest
+
+
+@pytest.mark.parametrize('spec', [
+    [],
+    {'width': 40},
+    {'height': 40.7, 'width': 40},
+    {'height': 40, 'width': '40'},
+    {'height': True, 'width': 40},
+    {'height': 0, 'width': 40},
+    {'height': 40, 'width': 4096},
+    {'height': 40, 'width': 40, 'seed': True},
+    {'height': 40, 'width': 40, 'seed': 1.5},
+    {'height': 40, 'width': 40, 'seed': -1},
+    {'height': 40, 'width': 40, 'steps': ['save']},
+    {'height': 40, 'width': 40, 'steps': [['generate_landmass',
+                                           {'unknown': 1}]]},
+    {'height': 40, 'width': 40, 'format': 'gif'},
+    {'height': 40, 'width': 40, 'pixel_size': False},
+    {'height': 40, 'width': 40, 'pixel_size': 17},
+    {'height': 2048, 'width': 2048, 'pixel_size': 4},
+])
+def test_invalid_jobs_are_refused(spec):
+    with pytest.raises(RequestError) as error:
+        parse_job(spec, 2048)
+    assert error.value.status == 400
+
+
+def test_jobs_are_filled_in():
+    job = parse_job({'height': 30, 'width': 40, 'seed': 5}, 2048)
+    assert job == {'height': 30, 'width': 40, 'seed': 5,
+                   'steps': [tuple(step) for step in map_batch.pipeline],
+                   'format': 'png', 'pixel_size': 1}
+
+
+def test_identical_jobs_share_a_map():
+    async def main():
+        service = Service(workers=1, max_jobs=1, threads=True)
+        await service.start()
+        spec = {'height': 30, 'width': 30, 'seed': 1, 'format': 'npz'}
+        job = service.submit(spec)
+        assert service.submit(dict(spec)) is job
+        # Only one job can run at once, identical jobs do not count
+        with pytest.raises(RequestError) as error:
+            service.submit({'height': 30, 'width': 30, 'seed': 2})
+        assert error.value.status == 503
+
+        await asyncio.wait_for(job.done.wait(), 30)
+        assert job.status == 'done'
+        assert service.submit(spec) is job
+        await service.stop()
+        assert not service.listener.is_alive()
+
+    asyncio.run(main())